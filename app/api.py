@@ -1,33 +1,173 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from typing import Optional
-import shutil
+from PIL import Image
+import psycopg2.errors
 import os
+import re
+import time
+import uuid
+import catalog_io
+import clip_utils
+import db_utils
+import search_cache
+from db_utils import get_db_conn, insert_product, get_product_by_barcode, EmbeddingModelChanged
+from gpt_utils import generate_product_info
+from metrics import timed, execute_query, render_prometheus
 
 app = FastAPI()
 
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+ACTIVE_MODEL_TTL = 30.0
+_active_model = {"expires": 0.0, "value": None}
+
+# Active embedding model, re-read periodically so a model cut-over is picked up
+def active_model():
+    """(model_id, model_name, pretrained); falls back to the CLIP_* defaults before migrations exist"""
+    if _active_model["expires"] < time.monotonic():
+        _active_model["value"] = db_utils.get_active_model() or (
+            None, clip_utils.CLIP_MODEL_NAME, clip_utils.CLIP_PRETRAINED
+        )
+        _active_model["expires"] = time.monotonic() + ACTIVE_MODEL_TTL
+    return _active_model["value"]
+
+def _read_image(upload):
+    try:
+        with timed("image_decode"):
+            return Image.open(upload.file).convert("RGB")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+
+def _results(rows):
+    return [
+        {"article_number": article_number, "product_name": product_name, "image_path": image_path,
+         "similarity": float(similarity)}
+        for article_number, product_name, image_path, similarity in rows
+    ]
+
+# Blocking handlers are plain functions so FastAPI runs them in its thread pool
 @app.post("/products/")
-async def add_product(
+def add_product(
     article_number: str = Form(...),
     product_name: str = Form(...),
     barcode: Optional[str] = Form(None),
+    tenant: Optional[str] = Form(None),
+    category: Optional[str] = Form(None),
     image: UploadFile = File(...)
 ):
-    image_path = os.path.join(UPLOAD_DIR, image.filename)
-    with open(image_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
-    # Here you would call your DB insert logic
+    article_number = article_number.upper().strip()
+    if not re.fullmatch(r"[A-Z0-9-]{6,32}", article_number):
+        raise HTTPException(status_code=400, detail="Article number must be 6-32 characters: A-Z, 0-9 and '-'")
+    picture = _read_image(image)
+    model_id, model_name, pretrained = active_model()
+    embedding = clip_utils.embed_image(picture, model_name, pretrained)
+
+    image_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.png")
+    with timed("image_save"):
+        picture.save(image_path)
+    try:
+        insert_product(article_number, product_name.strip(), image_path, embedding, barcode,
+                       model_id=model_id, tenant=tenant, category=category)
+    except (EmbeddingModelChanged, psycopg2.errors.UniqueViolation) as e:
+        os.remove(image_path)
+        _active_model["expires"] = 0.0
+        raise HTTPException(status_code=409, detail=str(e).strip())
     return {
         "article_number": article_number,
         "product_name": product_name,
         "barcode": barcode,
         "image_path": image_path,
-        "status": "Product added (DB logic not shown here)"
+        "status": "Product added"
     }
 
 @app.get("/products/{article_number}")
 async def get_product(article_number: str):
     # Here you would call your DB fetch logic
     return {"article_number": article_number, "status": "Fetched (DB logic not shown here)"}
+
+@app.get("/products/barcode/{barcode}")
+def get_product_for_barcode(barcode: str):
+    product = get_product_by_barcode(barcode)
+    if product is None:
+        raise HTTPException(status_code=404, detail="No product with this barcode")
+    article_number, product_name, image_path, _, _ = product
+    return {"article_number": article_number, "product_name": product_name, "image_path": image_path, "barcode": barcode}
+
+# Similar products for an uploaded photo
+@app.post("/search")
+def search(
+    image: UploadFile = File(...),
+    top_k: int = Form(3, ge=1, le=50),
+    min_similarity: float = Form(0.0),
+    tenant: Optional[str] = Form(None),
+    category: Optional[str] = Form(None)
+):
+    picture = _read_image(image)
+    # A cut-over since the active model was read: re-read it and re-encode once
+    for attempt in range(2):
+        model_id, model_name, pretrained = active_model()
+        embedding = clip_utils.embed_image(picture, model_name, pretrained)
+        try:
+            results = search_cache.find_similar(embedding, top_k=top_k, min_similarity=min_similarity,
+                                                tenant=tenant, category=category, model_id=model_id)
+            return {"results": _results(results)}
+        except EmbeddingModelChanged as e:
+            _active_model["expires"] = 0.0
+            error = e
+    raise HTTPException(status_code=503, detail=str(error))
+
+@app.get("/stats")
+def stats():
+    conn = get_db_conn()
+    try:
+        cur = conn.cursor()
+        execute_query(
+            cur, "stats_products",
+            "SELECT COUNT(*), COUNT(barcode), COUNT(DISTINCT tenant), COUNT(DISTINCT category) FROM products"
+        )
+        products, with_barcode, tenants, categories = cur.fetchone()
+        cur.close()
+    finally:
+        conn.close()
+    return {
+        "products": products,
+        "with_barcode": with_barcode,
+        "tenants": tenants,
+        "categories": categories,
+        "active_model": active_model()[0],
+    }
+
+# GPT product name/category suggestion for a short image description
+@app.post("/suggest")
+def suggest(description: str = Form(...)):
+    try:
+        return {"suggestion": generate_product_info(description)}
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Suggestion service error: {e}")
+
+# Stream the catalogue with embeddings from one snapshot, chunk by chunk
+@app.get("/export")
+def export_catalogue(
+    format: str = "jsonl",
+    tenant: Optional[str] = None,
+    category: Optional[str] = None,
+    chunk_rows: int = Query(catalog_io.DEFAULT_CHUNK_ROWS, ge=1, le=100000)
+):
+    if format == "jsonl":
+        stream, media_type = catalog_io.stream_jsonl(chunk_rows, tenant, category), "application/x-ndjson"
+    elif format == "parquet":
+        if not catalog_io.parquet_available():
+            raise HTTPException(status_code=501, detail="Parquet export requires pyarrow on the server")
+        stream, media_type = catalog_io.stream_parquet(chunk_rows, tenant, category), "application/vnd.apache.parquet"
+    else:
+        raise HTTPException(status_code=400, detail="format must be 'jsonl' or 'parquet'")
+    return StreamingResponse(
+        stream, media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="catalog.{format}"'}
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,263 @@
+"""
+Benchmark suite for the encode, ingest and search paths.
+
+Generates synthetic catalogues of random normalized embeddings, loads them into
+a local pgvector database and measures:
+
+- bulk-ingest throughput (rows/sec) through bulk_insert_products()
+- find_similar() latency percentiles and recall@k against a brute-force scan,
+  optionally with the catalogue spread over several categories (--partitions),
+  each with its own partial ANN index
+- CLIP encode throughput per batch size
+
+Results are written as JSON so runs can be compared across commits.
+
+The benchmark TRUNCATES the products table of the database it runs against, so
+it uses its own database (BENCH_DB_NAME, default "fruits_bench") on the server
+configured by the usual DB_* environment variables.
+
+Example:
+    python benchmark.py --sizes 10000 100000 --queries 200 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import psycopg2
+
+import db_utils
+import partitions as partitions_module
+
+EMBEDDING_DIM = 512
+CHUNK_SIZE = 10000
+QUERY_STREAM = 2 ** 32 - 1  # RNG stream for queries, distinct from every chunk index
+DEFAULT_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db", "init.sql")
+
+# Deterministic chunk of normalized embeddings, so brute force can regenerate it
+def synthetic_chunk(seed, chunk_index, rows):
+    rng = np.random.default_rng([seed, chunk_index])
+    chunk = rng.standard_normal((rows, EMBEDDING_DIM), dtype=np.float32)
+    return chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+
+def iter_chunks(size, seed):
+    for chunk_index, start in enumerate(range(0, size, CHUNK_SIZE)):
+        yield start, synthetic_chunk(seed, chunk_index, min(CHUNK_SIZE, size - start))
+
+def article_number(i):
+    return f"BENCH-{i:08d}"
+
+def percentiles_ms(samples):
+    samples = np.asarray(samples) * 1000.0
+    return {
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(samples.mean()),
+    }
+
+# Create the benchmark database if needed and apply the schema
+def prepare_database(dbname, schema_path):
+    admin_config = dict(db_utils.DB_CONFIG, dbname="postgres")
+    conn = psycopg2.connect(**admin_config)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
+    if cur.fetchone() is None:
+        cur.execute(f'CREATE DATABASE "{dbname}"')
+    cur.close()
+    conn.close()
+
+    db_utils.DB_CONFIG["dbname"] = dbname
+    conn = db_utils.get_db_conn()
+    cur = conn.cursor()
+    with open(schema_path) as f:
+        cur.execute(f.read())
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def reset_catalogue(conn):
+    cur = conn.cursor()
+    cur.execute("DROP INDEX IF EXISTS idx_bench_embedding")
+    cur.execute("SELECT index_name FROM search_partitions WHERE index_name IS NOT NULL")
+    for (name,) in cur.fetchall():
+        cur.execute(f'DROP INDEX IF EXISTS "{name}"')
+    cur.execute("TRUNCATE products, search_partitions RESTART IDENTITY")
+    conn.commit()
+    cur.close()
+
+def bench_category(i, partitions):
+    return f"bench-{i % partitions}" if partitions > 1 else None
+
+def ingest_catalogue(conn, size, seed, page_size, partitions):
+    started = time.perf_counter()
+    for start, chunk in iter_chunks(size, seed):
+        rows = (
+            (article_number(start + i), f"Bench product {start + i}", f"bench/{start + i:08d}.png", embedding, None,
+             None, bench_category(start + i, partitions))
+            for i, embedding in enumerate(chunk)
+        )
+        db_utils.bulk_insert_products(rows, conn=conn, page_size=page_size)
+    seconds = time.perf_counter() - started
+    return {"rows": size, "seconds": seconds, "rows_per_sec": size / seconds}
+
+def build_index(conn, index_type, size, partitions):
+    cur = conn.cursor()
+    started = time.perf_counter()
+    if index_type != "none" and partitions > 1:
+        for partition in range(partitions):
+            partitions_module.build_partition_index(db_utils.DEFAULT_TENANT, f"bench-{partition}", index_type)
+    elif index_type == "ivfflat":
+        lists = max(1, int(size ** 0.5))
+        cur.execute(
+            f"CREATE INDEX idx_bench_embedding ON products USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})"
+        )
+    elif index_type == "hnsw":
+        cur.execute("CREATE INDEX idx_bench_embedding ON products USING hnsw (embedding vector_cosine_ops)")
+    cur.execute("ANALYZE products")
+    conn.commit()
+    cur.close()
+    return {"type": index_type, "partitions": partitions, "build_seconds": time.perf_counter() - started}
+
+# Queries are perturbed catalogue vectors, so every query has true near neighbours
+def make_queries(size, seed, count, noise):
+    rng = np.random.default_rng([seed, QUERY_STREAM])
+    picks = rng.integers(0, size, count)
+    queries = np.empty((count, EMBEDDING_DIM), dtype=np.float32)
+    for chunk_index in np.unique(picks // CHUNK_SIZE):
+        start = chunk_index * CHUNK_SIZE
+        chunk = synthetic_chunk(seed, chunk_index, min(CHUNK_SIZE, size - start))
+        in_chunk = picks // CHUNK_SIZE == chunk_index
+        queries[in_chunk] = chunk[picks[in_chunk] - start]
+    queries += rng.standard_normal(queries.shape, dtype=np.float32) * noise
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+# Exact top-k by cosine similarity, streamed chunk by chunk to bound memory
+def brute_force_topk(queries, size, seed, top_k):
+    best_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), top_k), dtype=np.int64)
+    for start, chunk in iter_chunks(size, seed):
+        scores = np.concatenate([best_scores, queries @ chunk.T], axis=1)
+        ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, start + len(chunk)), (len(queries), len(chunk)))], axis=1)
+        order = np.argsort(-scores, axis=1)[:, :top_k]
+        best_scores = np.take_along_axis(scores, order, axis=1)
+        best_ids = np.take_along_axis(ids, order, axis=1)
+    return [{article_number(i) for i in row} for row in best_ids]
+
+def run_search(conn, queries, truth, top_k, warmup):
+    for query in queries[:warmup]:
+        db_utils.find_similar(query, top_k=top_k, conn=conn)
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        results = db_utils.find_similar(query, top_k=top_k, conn=conn)
+        latencies.append(time.perf_counter() - started)
+        hits += len({row[0] for row in results} & expected)
+    report = percentiles_ms(latencies)
+    report.update({"queries": len(queries), "top_k": top_k, "recall_at_k": hits / (len(queries) * top_k)})
+    return report
+
+def bench_catalogue(args, size):
+    print(f"== catalogue of {size} products")
+    conn = db_utils.get_db_conn()
+    reset_catalogue(conn)
+    ingest = ingest_catalogue(conn, size, args.seed, args.page_size, args.partitions)
+    print(f"   ingest: {ingest['rows_per_sec']:.0f} rows/sec")
+    index = build_index(conn, args.index, size, args.partitions)
+    queries = make_queries(size, args.seed, args.queries, args.noise)
+    truth = brute_force_topk(queries, size, args.seed, args.top_k)
+    search = run_search(conn, queries, truth, args.top_k, args.warmup)
+    print(f"   search: p50={search['p50_ms']:.1f}ms p95={search['p95_ms']:.1f}ms "
+          f"p99={search['p99_ms']:.1f}ms recall@{args.top_k}={search['recall_at_k']:.3f}")
+    conn.close()
+    return {"size": size, "ingest": ingest, "index": index, "search": search}
+
+def bench_encode(batch_sizes, iterations):
+    from PIL import Image
+    import clip_utils
+
+    model, preprocess = clip_utils.load_model()
+    rng = np.random.default_rng(0)
+    results = []
+    for batch_size in batch_sizes:
+        images = [
+            Image.fromarray(rng.integers(0, 256, (480, 640, 3), dtype=np.uint8))
+            for _ in range(batch_size)
+        ]
+        clip_utils.encode_images(images, model, preprocess)  # warm-up
+        started = time.perf_counter()
+        for _ in range(iterations):
+            clip_utils.encode_images(images, model, preprocess)
+        seconds = time.perf_counter() - started
+        results.append({
+            "batch_size": batch_size,
+            "iterations": iterations,
+            "images_per_sec": batch_size * iterations / seconds,
+            "batch_latency_ms": seconds / iterations * 1000.0,
+        })
+        print(f"== encode batch={batch_size}: {results[-1]['images_per_sec']:.1f} images/sec")
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark encode, ingest and search paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Synthetic catalogue sizes")
+    parser.add_argument("--queries", type=int, default=200, help="Search queries per catalogue")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed warm-up queries")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--noise", type=float, default=0.05, help="Query perturbation around catalogue vectors")
+    parser.add_argument("--index", choices=["none", "ivfflat", "hnsw"], default="none",
+                        help="Vector index to build before searching")
+    parser.add_argument("--partitions", type=int, default=1,
+                        help="Spread the catalogue over this many categories, indexed separately")
+    parser.add_argument("--page-size", type=int, default=1000, help="Rows per bulk INSERT statement")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32], help="CLIP encode batch sizes")
+    parser.add_argument("--encode-iterations", type=int, default=5)
+    parser.add_argument("--skip-encode", action="store_true", help="Skip the CLIP encode benchmark")
+    parser.add_argument("--skip-search", action="store_true", help="Skip the ingest/search benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dbname", default=os.environ.get("BENCH_DB_NAME", "fruits_bench"),
+                        help="Dedicated benchmark database (its products table is truncated)")
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA, help="Path to db/init.sql")
+    parser.add_argument("--output", default=f"bench-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "catalogues": [],
+        "encode": [],
+    }
+    if not args.skip_search:
+        prepare_database(args.dbname, args.schema)
+        for size in args.sizes:
+            report["catalogues"].append(bench_catalogue(args, size))
+    if not args.skip_encode:
+        report["encode"] = bench_encode(args.batch_sizes, args.encode_iterations)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
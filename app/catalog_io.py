@@ -0,0 +1,392 @@
+"""
+Streaming export and import of the product catalogue with its embeddings.
+
+Exports read one consistent snapshot (a read-only REPEATABLE READ transaction)
+through a server-side cursor, so memory stays bounded by the chunk size however
+large the catalogue is. Formats:
+
+    npy      directory of part-NNNNN.jsonl (product fields, one per line) and
+             part-NNNNN.npy (float32 embeddings, same row order), plus manifest.json
+    parquet  directory with catalog.parquet (one row group per chunk, embeddings
+             as a fixed-size float32 list) plus manifest.json; needs pyarrow
+    jsonl    single newline-delimited JSON stream with the embedding inline, as
+             served by GET /export (first line is the manifest)
+
+Imports COPY each chunk into a temporary table and merge it into products with
+one INSERT ... ON CONFLICT, committing per chunk, so an interrupted import can be
+re-run with --on-conflict skip. Embeddings are only meaningful for the model
+that produced them: the import refuses a file whose model differs from the
+active one. Image files are not included; copy the uploads folder alongside.
+
+Usage:
+    python catalog_io.py export --out /data/catalog [--format parquet] [--tenant store-1] [--category dairy]
+    python catalog_io.py import --src /data/catalog [--on-conflict skip|update|error]
+    python catalog_io.py import --src catalog.jsonl
+"""
+import argparse
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ, quote_ident
+
+from db_utils import get_db_conn, bump_catalogue_version, raise_if_model_changed, MODEL_IS_ACTIVE
+from metrics import timed, execute_query
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only the parquet format needs it
+    pa = pq = None
+
+EXPORT_COLUMNS = ("article_number", "product_name", "image_path", "barcode", "tenant", "category", "created_at", "updated_at")
+DEFAULT_CHUNK_ROWS = 10000
+MANIFEST_NAME = "manifest.json"
+PARQUET_NAME = "catalog.parquet"
+
+def parquet_available():
+    return pq is not None
+
+def _require_parquet():
+    if pq is None:
+        raise RuntimeError("The parquet format requires pyarrow (pip install pyarrow)")
+
+# --- Export ---
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+# Parse a chunk of pgvector text values ('[0.1,0.2,...]') in one pass
+def _parse_embeddings(texts):
+    flat = np.fromstring(",".join(text[1:-1] for text in texts), sep=",", dtype=np.float32)
+    return flat.reshape(len(texts), -1)
+
+# Staging columns of registered candidate models (see migrate_embeddings.py)
+def _staging_columns(cur):
+    execute_query(cur, "catalog_staging_columns", "SELECT staging_column FROM embedding_models WHERE NOT is_active")
+    return [row[0] for row in cur.fetchall()]
+
+def _active_model(cur):
+    execute_query(cur, "catalog_active_model", "SELECT model_id, dim FROM embedding_models WHERE is_active")
+    row = cur.fetchone()
+    if row is None:
+        raise RuntimeError("No active embedding model")
+    return row
+
+# Read the catalogue in chunks from one consistent snapshot
+def iter_catalogue(chunk_rows=DEFAULT_CHUNK_ROWS, tenant=None, category=None):
+    """
+    Yields the manifest dict first, then (records, embeddings) chunks where records
+    are tuples in EXPORT_COLUMNS order and embeddings a float32 (n, dim) array
+    """
+    conn = get_db_conn()
+    conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    try:
+        cur = conn.cursor()
+        model_id, dim = _active_model(cur)
+        cur.close()
+        yield {
+            "model_id": model_id, "dim": dim, "columns": list(EXPORT_COLUMNS),
+            "filter": {"tenant": tenant, "category": category},
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+        conditions, params = ["embedding IS NOT NULL"], []
+        if tenant is not None:
+            conditions.append("tenant = %s")
+            params.append(tenant)
+        if category is not None:
+            conditions.append("category = %s")
+            params.append(category)
+        cur = conn.cursor(name="catalog_export")  # server-side cursor: bounded memory
+        cur.itersize = chunk_rows
+        execute_query(
+            cur, "catalog_export",
+            f"SELECT {', '.join(EXPORT_COLUMNS)}, embedding FROM products WHERE {' AND '.join(conditions)} ORDER BY id",
+            params
+        )
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            with timed("catalog_export_chunk"):
+                embeddings = _parse_embeddings([row[-1] for row in rows])
+            yield [row[:-1] for row in rows], embeddings
+        cur.close()
+    finally:
+        conn.close()
+
+def _write_manifest(out_dir, manifest):
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+def _parquet_schema(manifest):
+    return pa.schema(
+        [
+            ("article_number", pa.string()), ("product_name", pa.string()), ("image_path", pa.string()),
+            ("barcode", pa.string()), ("tenant", pa.string()), ("category", pa.string()),
+            ("created_at", pa.timestamp("us", tz="UTC")), ("updated_at", pa.timestamp("us", tz="UTC")),
+            ("embedding", pa.list_(pa.float32(), manifest["dim"])),
+        ],
+        metadata={"catalog_manifest": json.dumps(manifest)},
+    )
+
+def _parquet_table(records, embeddings, schema):
+    columns = [
+        pa.array([record[i] for record in records], type=schema.field(name).type)
+        for i, name in enumerate(EXPORT_COLUMNS)
+    ]
+    columns.append(pa.FixedSizeListArray.from_arrays(pa.array(embeddings.reshape(-1)), embeddings.shape[1]))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+# Export to a directory in the npy or parquet layout; returns the manifest
+def export_catalogue(out_dir, fmt="npy", chunk_rows=DEFAULT_CHUNK_ROWS, tenant=None, category=None):
+    if fmt == "parquet":
+        _require_parquet()
+    os.makedirs(out_dir, exist_ok=True)
+    chunks = iter_catalogue(chunk_rows, tenant, category)
+    manifest = next(chunks)
+    manifest.update(format=fmt, rows=0, parts=[])
+    writer = None
+    try:
+        if fmt == "parquet":
+            schema = _parquet_schema(manifest)
+            writer = pq.ParquetWriter(os.path.join(out_dir, PARQUET_NAME), schema)
+            manifest["parts"].append(PARQUET_NAME)
+        for part, (records, embeddings) in enumerate(chunks):
+            if fmt == "parquet":
+                writer.write_table(_parquet_table(records, embeddings, schema))
+            else:
+                name = f"part-{part:05d}"
+                with open(os.path.join(out_dir, f"{name}.jsonl"), "w") as f:
+                    for record in records:
+                        f.write(json.dumps(dict(zip(EXPORT_COLUMNS, record)), default=_json_default) + "\n")
+                np.save(os.path.join(out_dir, f"{name}.npy"), embeddings)
+                manifest["parts"].append(name)
+            manifest["rows"] += len(records)
+    finally:
+        if writer is not None:
+            writer.close()
+    _write_manifest(out_dir, manifest)
+    return manifest
+
+# Newline-delimited JSON stream (manifest line, then one product per line) for HTTP export
+def stream_jsonl(chunk_rows=DEFAULT_CHUNK_ROWS, tenant=None, category=None):
+    chunks = iter_catalogue(chunk_rows, tenant, category)
+    manifest = next(chunks)
+    manifest["format"] = "jsonl"
+    yield (json.dumps({"manifest": manifest}) + "\n").encode()
+    for records, embeddings in chunks:
+        lines = []
+        for record, embedding in zip(records, embeddings):
+            item = dict(zip(EXPORT_COLUMNS, record))
+            item["embedding"] = embedding.tolist()
+            lines.append(json.dumps(item, default=_json_default))
+        yield ("\n".join(lines) + "\n").encode()
+
+# Parquet file streamed one row group at a time for HTTP export
+def stream_parquet(chunk_rows=DEFAULT_CHUNK_ROWS, tenant=None, category=None):
+    _require_parquet()
+    chunks = iter_catalogue(chunk_rows, tenant, category)
+    manifest = next(chunks)
+    manifest["format"] = "parquet"
+    schema = _parquet_schema(manifest)
+    sink = io.BytesIO()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    for records, embeddings in chunks:
+        writer.write_table(_parquet_table(records, embeddings, schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+# --- Import ---
+
+# Open an export (directory, .parquet or .jsonl file); returns (manifest, chunk iterator)
+def read_catalogue(src, chunk_rows=DEFAULT_CHUNK_ROWS):
+    if os.path.isdir(src):
+        with open(os.path.join(src, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest["format"] == "parquet":
+            return manifest, _read_parquet(os.path.join(src, PARQUET_NAME), chunk_rows)
+        return manifest, _read_npy_parts(src, manifest["parts"])
+    if src.endswith(".parquet"):
+        _require_parquet()
+        manifest = json.loads(pq.read_schema(src).metadata[b"catalog_manifest"])
+        return manifest, _read_parquet(src, chunk_rows)
+    f = open(src)
+    manifest = json.loads(f.readline())["manifest"]
+    return manifest, _read_jsonl(f, chunk_rows)
+
+def _read_npy_parts(src, parts):
+    for name in parts:
+        with open(os.path.join(src, f"{name}.jsonl")) as f:
+            records = [tuple(map(json.loads(line).get, EXPORT_COLUMNS)) for line in f]
+        yield records, np.load(os.path.join(src, f"{name}.npy"))
+
+def _read_parquet(path, chunk_rows):
+    _require_parquet()
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+        columns = [batch.column(name).to_pylist() for name in EXPORT_COLUMNS]
+        embedding_column = batch.column("embedding")
+        embeddings = embedding_column.flatten().to_numpy().reshape(len(batch), -1)
+        yield list(zip(*columns)), embeddings
+
+def _read_jsonl(f, chunk_rows):
+    with f:
+        records, embeddings = [], []
+        for line in f:
+            item = json.loads(line)
+            records.append(tuple(map(item.get, EXPORT_COLUMNS)))
+            embeddings.append(item["embedding"])
+            if len(records) == chunk_rows:
+                yield records, np.asarray(embeddings, dtype=np.float32)
+                records, embeddings = [], []
+        if records:
+            yield records, np.asarray(embeddings, dtype=np.float32)
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+# One chunk in COPY text format, embeddings written with exact float32 round-trip
+def _copy_buffer(records, embeddings):
+    vectors = io.StringIO()
+    np.savetxt(vectors, embeddings, fmt="%.9g", delimiter=",")
+    buffer = io.StringIO()
+    for record, vector in zip(records, vectors.getvalue().splitlines()):
+        buffer.write("\t".join(_copy_value(value) for value in record))
+        buffer.write(f"\t[{vector}]\n")
+    buffer.seek(0)
+    return buffer
+
+_ON_CONFLICT = {
+    "error": "",
+    "skip": "ON CONFLICT (article_number) DO NOTHING",
+    "update": """
+        ON CONFLICT (article_number) DO UPDATE SET
+            product_name = EXCLUDED.product_name, image_path = EXCLUDED.image_path,
+            barcode = EXCLUDED.barcode, tenant = EXCLUDED.tenant, category = EXCLUDED.category,
+            embedding = EXCLUDED.embedding, updated_at = now(){staging}
+    """,
+}
+
+# Load an export into products; returns (rows read, rows written)
+def import_catalogue(src, on_conflict="error", chunk_rows=DEFAULT_CHUNK_ROWS):
+    manifest, chunks = read_catalogue(src, chunk_rows)
+    conn = get_db_conn()
+    read = written = 0
+    try:
+        cur = conn.cursor()
+        model_id, dim = _active_model(cur)
+        # A replaced image invalidates every candidate model's embedding of it; the
+        # backfill and cut-over re-encode NULL staging columns
+        staging = "".join(f", {quote_ident(column, cur)} = NULL" for column in _staging_columns(cur))
+        on_conflict_sql = _ON_CONFLICT[on_conflict].replace("{staging}", staging)
+        if manifest["model_id"] != model_id:
+            raise ValueError(
+                f"Export was made with embedding model {manifest['model_id']}, but {model_id} is active; "
+                "cut over to the same model first (see migrate_embeddings.py)"
+            )
+        execute_query(
+            cur, "catalog_import_staging",
+            f"""
+            CREATE TEMP TABLE catalog_import (
+                {', '.join(f'{column} TEXT' for column in EXPORT_COLUMNS)},
+                embedding vector({int(dim)})
+            )
+            """
+        )
+        conn.commit()
+        for records, embeddings in chunks:
+            with timed("catalog_import_chunk"):
+                cur.copy_expert(
+                    f"COPY catalog_import ({', '.join(EXPORT_COLUMNS)}, embedding) FROM STDIN",
+                    _copy_buffer(records, embeddings),
+                )
+                # Only merged while the export's model is still active (see db_utils.MODEL_IS_ACTIVE)
+                try:
+                    execute_query(
+                        cur, "catalog_import_merge",
+                        f"""
+                        INSERT INTO products (article_number, product_name, image_path, barcode, tenant, category,
+                                              created_at, updated_at, embedding)
+                        SELECT article_number, product_name, image_path, barcode, tenant, category,
+                               COALESCE(created_at::timestamptz, now()), COALESCE(updated_at::timestamptz, now()),
+                               embedding
+                        FROM catalog_import
+                        WHERE {MODEL_IS_ACTIVE}
+                        {on_conflict_sql}
+                        """,
+                        (model_id,)
+                    )
+                except psycopg2.errors.UniqueViolation:
+                    raise
+                except psycopg2.Error:
+                    raise_if_model_changed(conn, model_id)
+                    raise
+                if cur.rowcount == 0 and records:
+                    raise_if_model_changed(conn, model_id)
+                written += cur.rowcount
+                execute_query(cur, "catalog_import_truncate", "TRUNCATE catalog_import")
+                conn.commit()
+            read += len(records)
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        bump_catalogue_version()
+    return read, written
+
+def cmd_export(args):
+    manifest = export_catalogue(args.out, args.format, args.chunk_rows, args.tenant, args.category)
+    print(f"Exported {manifest['rows']} products ({manifest['model_id']}, {manifest['dim']} dims) to {args.out}")
+
+def cmd_import(args):
+    try:
+        read, written = import_catalogue(args.src, args.on_conflict, args.chunk_rows)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f"Imported {written} of {read} products from {args.src}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import the product catalogue with embeddings")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Write a consistent snapshot of the catalogue")
+    export.add_argument("--out", required=True, help="Output directory")
+    export.add_argument("--format", choices=["npy", "parquet"], default="npy")
+    export.add_argument("--tenant", default=None)
+    export.add_argument("--category", default=None)
+    export.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS)
+    export.set_defaults(func=cmd_export)
+
+    load = commands.add_parser("import", help="Load an export into this database")
+    load.add_argument("--src", required=True, help="Export directory, .parquet or .jsonl file")
+    load.add_argument("--on-conflict", choices=sorted(_ON_CONFLICT), default="error",
+                      help="What to do with article numbers that already exist")
+    load.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS)
+    load.set_defaults(func=cmd_import)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
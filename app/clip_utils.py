@@ -0,0 +1,94 @@
+"""
+CLIP model loading and image encoding.
+
+torch and open_clip are imported lazily, on the first model load, so pages that
+never encode an image do not pay the import cost. The loaded model is cached
+once per process (per architecture/weights pair) and shared by the UI and the
+optional background warm-up. The defaults below are used until the database
+names an active embedding model (see migrate_embeddings.py).
+
+Environment:
+    CLIP_MODEL       open_clip architecture name (default "ViT-B-32")
+    CLIP_PRETRAINED  pretrained tag or path to a local checkpoint (default "openai")
+    CLIP_CACHE_DIR   directory holding pre-fetched weights (see app/Dockerfile)
+    CLIP_WARMUP      "1" to load the model and run a dummy batch at startup
+    INFERENCE_SOCKET Unix socket(s) of the shared inference worker; when set,
+                     embed_images() encodes there instead of loading a local copy
+"""
+import os
+import threading
+import numpy as np
+from metrics import timed
+
+CLIP_MODEL_NAME = os.environ.get("CLIP_MODEL", "ViT-B-32")
+CLIP_PRETRAINED = os.environ.get("CLIP_PRETRAINED", "openai")
+CLIP_CACHE_DIR = os.environ.get("CLIP_CACHE_DIR") or None
+CLIP_WARMUP = os.environ.get("CLIP_WARMUP", "0") == "1"
+INFERENCE_SOCKET = os.environ.get("INFERENCE_SOCKET") or None
+
+_model_lock = threading.Lock()
+_models = {}  # (model_name, pretrained) -> (model, preprocess)
+_warmup_thread = None
+
+# Load CLIP model and its preprocessing transform
+def load_model(model_name=None, pretrained=None):
+    import open_clip
+
+    with timed("model_load"):
+        model, _, preprocess = open_clip.create_model_and_transforms(
+            model_name or CLIP_MODEL_NAME, pretrained=pretrained or CLIP_PRETRAINED, cache_dir=CLIP_CACHE_DIR
+        )
+        model.eval()
+    return model, preprocess
+
+# Process-wide cached model, loaded on first use
+def get_model(model_name=None, pretrained=None):
+    key = (model_name or CLIP_MODEL_NAME, pretrained or CLIP_PRETRAINED)
+    with _model_lock:
+        if key not in _models:
+            _models[key] = load_model(*key)
+        return _models[key]
+
+# Encode a batch of PIL images into L2-normalized embeddings
+def encode_images(images, model, preprocess):
+    """Returns a float32 numpy array of shape (len(images), embedding_dim)"""
+    import torch
+
+    with timed("preprocess"):
+        batch = torch.stack([preprocess(image) for image in images])
+    with timed("encode_image"), torch.no_grad():
+        embeddings = model.encode_image(batch).cpu().numpy().astype(np.float32)
+    # Normalize the embeddings to improve similarity search accuracy
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+# Encode a single PIL image into an L2-normalized embedding
+def encode_image(image, model, preprocess):
+    return encode_images([image], model, preprocess)[0]
+
+# Encode PIL images with the shared inference worker if configured, else in-process
+def embed_images(images, model_name=None, pretrained=None):
+    if INFERENCE_SOCKET:
+        import inference_worker
+        return inference_worker.encode_remote(images, INFERENCE_SOCKET, model_name, pretrained)
+    model, preprocess = get_model(model_name, pretrained)
+    return encode_images(images, model, preprocess)
+
+def embed_image(image, model_name=None, pretrained=None):
+    return embed_images([image], model_name, pretrained)[0]
+
+def _warm_up(batch_size):
+    from PIL import Image
+
+    dummy = [Image.new("RGB", (224, 224)) for _ in range(batch_size)]
+    with timed("model_warmup"):
+        embed_images(dummy)
+
+# Load the model (or reach the inference worker) and run a dummy batch in a background thread
+def start_warmup(batch_size=1):
+    """Returns the warm-up thread; calling it again reuses the running one"""
+    global _warmup_thread
+    with _model_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=_warm_up, args=(batch_size,), name="clip-warmup", daemon=True)
+            _warmup_thread.start()
+        return _warmup_thread
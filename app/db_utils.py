@@ -0,0 +1,473 @@
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
+import os
+import ast
+import itertools
+import select
+import threading
+import time
+from metrics import timed, execute_query
+
+# Database configuration
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "localhost"),
+    "port": int(os.environ.get("DB_PORT", 5432)),
+    "dbname": os.environ.get("DB_NAME", "fruits"),
+    "user": os.environ.get("DB_USER", "postgres"),
+    "password": os.environ.get("DB_PASSWORD", "postgres")
+}
+
+# Partition defaults, matching the column defaults in db/init.sql
+DEFAULT_TENANT = "default"
+DEFAULT_CATEGORY = "uncategorized"
+PARTITION_CACHE_TTL = 30.0
+
+# Search caches key on the catalogue version. The shared part is bumped in the
+# database by every change (see catalogue_state in db/init.sql) and followed here
+# through LISTEN/NOTIFY; the local part is bumped right after this process writes,
+# before its own notification arrives.
+CATALOGUE_CHANNEL = "catalogue_changed"
+CATALOGUE_LISTEN_RETRY = 5.0
+CATALOGUE_LISTEN_PING = 30.0
+
+_catalogue_versions = itertools.count(1)
+_catalogue_state = {"shared": None, "local": 0}
+_listener_lock = threading.Lock()
+_listener = None
+
+def catalogue_version():
+    """Current version key, or None while the shared version is unknown (nothing may be cached)"""
+    _start_catalogue_listener()
+    shared = _catalogue_state["shared"]
+    if shared is None:
+        return None
+    return shared, _catalogue_state["local"]
+
+def bump_catalogue_version():
+    _catalogue_state["local"] = next(_catalogue_versions)
+
+def _start_catalogue_listener():
+    global _listener
+    if _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen_catalogue_changes, name="catalogue-listener", daemon=True)
+            _listener.start()
+
+# Follow the shared catalogue version; reconnects after database errors
+def _listen_catalogue_changes():
+    while True:
+        conn = None
+        try:
+            conn = get_db_conn()
+            conn.autocommit = True
+            cur = conn.cursor()
+            # LISTEN first, so no change between reading the version and listening is missed
+            cur.execute(f"LISTEN {CATALOGUE_CHANNEL}")
+            execute_query(cur, "catalogue_version", "SELECT version FROM catalogue_state")
+            _catalogue_state["shared"] = cur.fetchone()[0]
+            while True:
+                if select.select([conn], [], [], CATALOGUE_LISTEN_PING) == ([], [], []):
+                    cur.execute("SELECT 1")  # notice a dropped connection while idle
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    version = int(conn.notifies.pop(0).payload)
+                    _catalogue_state["shared"] = max(_catalogue_state["shared"], version)
+        except (psycopg2.Error, OSError, ValueError):
+            _catalogue_state["shared"] = None
+            if conn is not None:
+                conn.close()
+            time.sleep(CATALOGUE_LISTEN_RETRY)
+
+# Get DB connection
+def get_db_conn():
+    with timed("db_connect"):
+        return psycopg2.connect(**DB_CONFIG)
+
+# Convert an embedding to a plain list for database queries
+def to_embedding_list(embedding):
+    """Accepts a numpy array, a list, or a vector as returned by the database"""
+    if hasattr(embedding, 'tolist'):
+        # If it's a numpy array, convert to list
+        return embedding.tolist()
+    if isinstance(embedding, list):
+        # If it's already a list, use as is
+        return embedding
+    # If it's from database (might be string or other format), convert to list
+    if isinstance(embedding, str):
+        # Parse string representation of array
+        try:
+            return ast.literal_eval(embedding)
+        except (ValueError, SyntaxError):
+            # Fallback: assume it's already in the right format
+            return embedding
+    return list(embedding)
+
+class EmbeddingModelChanged(Exception):
+    """The active embedding model changed after the embedding was computed"""
+
+# Active embedding model as (model_id, model_name, pretrained), or None before migrations exist
+def get_active_model():
+    conn = get_db_conn()
+    cur = conn.cursor()
+    try:
+        execute_query(
+            cur, "get_active_model",
+            "SELECT model_id, model_name, pretrained FROM embedding_models WHERE is_active"
+        )
+        return cur.fetchone()
+    except psycopg2.errors.UndefinedTable:
+        return None
+    finally:
+        cur.close()
+        conn.close()
+
+# SQL condition that holds only while model_id is the active embedding model. It is
+# uncorrelated, so PostgreSQL evaluates it once and scans nothing when it is false.
+MODEL_IS_ACTIVE = "(SELECT model_id FROM embedding_models WHERE is_active) = %s"
+
+# Called when a model-gated statement failed or matched nothing
+def raise_if_model_changed(conn, model_id):
+    """Raise EmbeddingModelChanged (after rolling back) when model_id is no longer active"""
+    conn.rollback()
+    cur = conn.cursor()
+    execute_query(cur, "check_active_model", "SELECT 1 FROM embedding_models WHERE is_active AND model_id = %s",
+                  (model_id,))
+    active = cur.fetchone()
+    conn.rollback()
+    cur.close()
+    if active is None:
+        raise EmbeddingModelChanged(f"Embedding model {model_id} is no longer active; re-encode and retry")
+
+# Insert product into the DB
+def insert_product(article_number, product_name, image_path, embedding, barcode=None, model_id=None,
+                   tenant=None, category=None):
+    """
+    Insert a product; when model_id is given the row is only written if that model
+    is still the active one, so a cut-over can never mix embedding spaces
+    """
+    conn = get_db_conn()
+    cur = conn.cursor()
+    tenant = tenant or DEFAULT_TENANT
+    category = category or DEFAULT_CATEGORY
+    try:
+        if model_id is None:
+            execute_query(
+                cur, "insert_product",
+                """
+                INSERT INTO products (article_number, product_name, image_path, embedding, barcode, tenant, category, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, now(), now())
+                """,
+                (article_number, product_name, image_path, embedding.tolist(), barcode, tenant, category)
+            )
+        else:
+            try:
+                execute_query(
+                    cur, "insert_product",
+                    f"""
+                    INSERT INTO products (article_number, product_name, image_path, embedding, barcode, tenant, category, created_at, updated_at)
+                    SELECT %s, %s, %s, %s, %s, %s, %s, now(), now()
+                    WHERE {MODEL_IS_ACTIVE}
+                    """,
+                    (article_number, product_name, image_path, embedding.tolist(), barcode, tenant, category, model_id)
+                )
+            except psycopg2.errors.UniqueViolation:
+                raise
+            except psycopg2.Error:
+                # An embedding of another dimension fails the column type check before the condition runs
+                raise_if_model_changed(conn, model_id)
+                raise
+            if cur.rowcount == 0:
+                raise_if_model_changed(conn, model_id)
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+    bump_catalogue_version()
+
+# Insert many products in one round trip per page
+def bulk_insert_products(rows, conn=None, page_size=1000):
+    """
+    Insert products in bulk using multi-row VALUES statements
+
+    Args:
+        rows: Iterable of (article_number, product_name, image_path, embedding, barcode, tenant, category)
+              tuples; tenant and category may be None for the defaults
+        conn: Optional open connection (committed here, but not closed)
+        page_size: Number of rows sent per INSERT statement
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_conn()
+    cur = conn.cursor()
+    with timed("bulk_insert"):
+        execute_values(
+            cur,
+            """
+            INSERT INTO products (article_number, product_name, image_path, embedding, barcode, tenant, category, created_at, updated_at)
+            VALUES %s
+            """,
+            (
+                (article_number, product_name, image_path, to_embedding_list(embedding), barcode,
+                 tenant or DEFAULT_TENANT, category or DEFAULT_CATEGORY)
+                for article_number, product_name, image_path, embedding, barcode, tenant, category in rows
+            ),
+            template="(%s, %s, %s, %s::vector, %s, %s, %s, now(), now())",
+            page_size=page_size,
+        )
+    inserted = cur.rowcount
+    conn.commit()
+    cur.close()
+    if own_conn:
+        conn.close()
+    bump_catalogue_version()
+    return inserted
+
+_partition_lock = threading.Lock()
+_partition_cache = {"expires": 0.0, "version": None, "partitions": []}
+
+# Registered (tenant, category, index_name) partitions
+def get_search_partitions(conn=None, refresh=False):
+    """
+    None when the database has no partition registry yet. Cached only while the shared catalogue version is followed: a new partition or
+    index from any process bumps it, so the cached registry is never missing one
+    """
+    version = catalogue_version()  # read before the query, so a concurrent change is not hidden
+    with _partition_lock:
+        cache = _partition_cache
+        if (not refresh and version is not None and cache["version"] == version
+                and cache["expires"] > time.monotonic()):
+            return cache["partitions"]
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_conn()
+    cur = conn.cursor()
+    try:
+        execute_query(
+            cur, "get_search_partitions",
+            "SELECT tenant, category, index_name FROM search_partitions ORDER BY tenant, category"
+        )
+        partitions = cur.fetchall()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        partitions = None  # database created before partitions existed (see README, Upgrading)
+    finally:
+        cur.close()
+        if own_conn:
+            conn.close()
+    with _partition_lock:
+        _partition_cache.update(
+            expires=time.monotonic() + PARTITION_CACHE_TTL, version=version, partitions=partitions
+        )
+    return partitions
+
+# Run a search statement; with model_id, tell a cut-over apart from an empty result
+def _fetch_search(conn, cur, query_name, query, params, model_id):
+    try:
+        execute_query(cur, query_name, query, params)
+        results = cur.fetchall()
+    except psycopg2.Error:
+        # A query embedding of another dimension fails before the model condition runs
+        if model_id is not None:
+            raise_if_model_changed(conn, model_id)
+        raise
+    if not results and model_id is not None:
+        raise_if_model_changed(conn, model_id)
+    return results
+
+# Per-branch top-k subqueries, merged with UNION ALL (scatter-gather in one statement)
+def _candidate_branches(branches, query_vector, top_k, model_id):
+    """
+    Returns (sql, params) yielding (article_number, product_name, image_path, distance)
+    rows for the query vector expression. branches is a list of (condition, params)
+    restricting each subquery to some products; literal partition keys in a condition
+    let the planner match it to that partition's partial ANN index.
+    """
+    model_filter = f"AND {MODEL_IS_ACTIVE}" if model_id is not None else ""
+    model_params = (model_id,) if model_id is not None else ()
+    sql_parts, params = [], []
+    for condition, condition_params in branches:
+        sql_parts.append(f"""
+            (SELECT article_number, product_name, image_path, embedding <=> {query_vector} AS distance
+             FROM products
+             WHERE {condition} AND embedding IS NOT NULL {model_filter}
+             ORDER BY embedding <=> {query_vector}
+             LIMIT %s)
+        """)
+        params.extend((*condition_params, *model_params, top_k))
+    return " UNION ALL ".join(sql_parts), params
+
+# The (condition, params) branches a search fans out over; [] when no partition matches
+def _search_plan(conn, tenant, category):
+    registry = get_search_partitions(conn)
+    if registry is None:
+        # No partition registry: one scan over the whole table, filtered directly
+        conditions, params = ["TRUE"], []
+        if tenant is not None:
+            conditions.append("tenant = %s")
+            params.append(tenant)
+        if category is not None:
+            conditions.append("category = %s")
+            params.append(category)
+        return [(" AND ".join(conditions), params)]
+    partitions = [
+        (p_tenant, p_category, index_name)
+        for p_tenant, p_category, index_name in registry
+        if (tenant is None or p_tenant == tenant) and (category is None or p_category == category)
+    ]
+    if not partitions:
+        return []
+    # Each indexed partition gets its own branch, so it is searched through its partial index
+    indexed = [(p_tenant, p_category) for p_tenant, p_category, index_name in partitions if index_name]
+    plan = [("tenant = %s AND category = %s", [p_tenant, p_category]) for p_tenant, p_category in indexed]
+    if tenant is None and category is None:
+        # Everything else in one scan over the rest of the table
+        if not indexed:
+            return [("TRUE", [])]
+        rows = ", ".join(["(%s, %s)"] * len(indexed))
+        plan.append((f"(tenant, category) NOT IN (VALUES {rows})", [key for pair in indexed for key in pair]))
+    else:
+        # The small unindexed partitions of the filter share one branch through the (tenant, category) btree
+        unindexed = [(p_tenant, p_category) for p_tenant, p_category, index_name in partitions if not index_name]
+        if unindexed:
+            rows = ", ".join(["(%s, %s)"] * len(unindexed))
+            plan.append((f"(tenant, category) IN (VALUES {rows})", [key for pair in unindexed for key in pair]))
+    return plan
+
+# Find similar products - IMPROVED to show Top 3 with better similarity calculation
+def find_similar(embedding, top_k=3, min_similarity=0.0, conn=None, tenant=None, category=None, model_id=None):
+    """
+    Find the most similar products, always returning top_k results if available
+
+    Args:
+        embedding: Query embedding vector (can be numpy array, list, or database vector)
+        top_k: Number of top similar products to return (default: 3)
+        min_similarity: Minimum similarity threshold (default: 0.0 to include all)
+        conn: Optional open connection to reuse (left open for the caller)
+        tenant: Optional store to search within
+        category: Optional category to search within
+        model_id: Embedding model the query was encoded with; when given, the search
+                  raises EmbeddingModelChanged instead of comparing across models
+
+    The search is pruned to the partitions matching tenant/category. Each remaining
+    partition is searched on its own, using its partial ANN index when one has been
+    built, and the per-partition top-k are merged (scatter-gather in one statement).
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_conn()
+    cur = conn.cursor()
+
+    # Convert embedding to proper format for database query
+    embedding_list = to_embedding_list(embedding)
+
+    try:
+        plan = _search_plan(conn, tenant, category)
+        if not plan:
+            return []
+        branches, branch_params = _candidate_branches(plan, "(SELECT v FROM q)", top_k, model_id)
+        results = _fetch_search(
+            conn, cur, "find_similar_topk" if len(plan) == 1 else "find_similar_partitioned",
+            f"""
+            WITH q AS (SELECT %s::vector AS v)
+            SELECT article_number, product_name, image_path, 1 - distance as similarity
+            FROM ({branches}) candidates
+            ORDER BY distance
+            LIMIT %s
+            """,
+            [embedding_list, *branch_params, top_k],
+            model_id
+        )
+    finally:
+        cur.close()
+        if own_conn:
+            conn.close()
+
+    # A positive threshold never empties the result: when fewer than top_k products
+    # pass it, the best top_k are returned regardless. Other thresholds just filter.
+    if min_similarity <= 0:
+        results = [row for row in results if row[3] >= min_similarity]
+    return results
+
+# Fetch product by barcode
+def get_product_by_barcode(barcode):
+    """(article_number, product_name, image_path, embedding, model_id of the embedding), or None"""
+    conn = get_db_conn()
+    cur = conn.cursor()
+    execute_query(
+        cur, "get_product_by_barcode",
+        """
+        SELECT p.article_number, p.product_name, p.image_path, p.embedding, m.model_id
+        FROM products p LEFT JOIN embedding_models m ON m.is_active
+        WHERE p.barcode = %s
+        """,
+        (barcode,)
+    )
+    result = cur.fetchone()
+    cur.close()
+    conn.close()
+    return result
+
+# Find similar products for several query embeddings in one round trip
+def find_similar_batch(embeddings, top_k=3, min_similarity=0.0, conn=None, tenant=None, category=None,
+                       model_id=None):
+    """
+    Run one top-k search per query embedding in a single SQL statement
+
+    Args:
+        embeddings: Sequence of query embedding vectors
+        top_k: Number of results per query
+        min_similarity: Minimum similarity threshold per result
+        conn: Optional open connection to reuse (left open for the caller)
+        tenant: Optional store to search within
+        category: Optional category to search within
+        model_id: Embedding model the queries were encoded with (see find_similar)
+
+    Returns:
+        A list with one result list per query, each of
+        (article_number, product_name, image_path, similarity) tuples
+    """
+    if len(embeddings) == 0:
+        return []
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_conn()
+    cur = conn.cursor()
+    vectors = [str(to_embedding_list(e)) for e in embeddings]
+    try:
+        plan = _search_plan(conn, tenant, category)
+        if not plan:
+            return [[] for _ in vectors]
+        # The same per-partition branches as find_similar(), run once per query vector
+        branches, branch_params = _candidate_branches(plan, "q.v", top_k, model_id)
+        rows = _fetch_search(
+            conn, cur, "find_similar_batch",
+            f"""
+            WITH q AS (
+                SELECT vec::vector AS v, idx FROM unnest(%s::text[]) WITH ORDINALITY AS t(vec, idx)
+            )
+            SELECT q.idx, r.article_number, r.product_name, r.image_path, 1 - r.distance AS similarity
+            FROM q
+            CROSS JOIN LATERAL (
+                SELECT article_number, product_name, image_path, distance
+                FROM ({branches}) candidates
+                ORDER BY distance
+                LIMIT %s
+            ) r
+            WHERE 1 - r.distance >= %s
+            ORDER BY q.idx, r.distance
+            """,
+            [vectors, *branch_params, top_k, min_similarity],
+            model_id
+        )
+    finally:
+        cur.close()
+        if own_conn:
+            conn.close()
+    results = [[] for _ in vectors]
+    for idx, article_number, product_name, image_path, similarity in rows:
+        results[idx - 1].append((article_number, product_name, image_path, similarity))
+    return results
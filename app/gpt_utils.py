@@ -1,5 +1,6 @@
 import openai
 import os
+from metrics import timed
 
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
@@ -12,10 +13,11 @@ def generate_product_info(image_description, api_key=None):
         f"Given the following product image description: '{image_description}', "
         "suggest a product name, category, and a short description."
     )
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=150,
-        temperature=0.7,
-    )
+    with timed("gpt_call"):
+        response = client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=150,
+            temperature=0.7,
+        )
     return response.choices[0].message.content.strip()
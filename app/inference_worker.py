@@ -0,0 +1,221 @@
+"""
+Long-lived CLIP inference worker shared by Streamlit sessions and API workers.
+
+One process loads the model once and serves encode requests over a local Unix
+socket. Front-ends write decoded RGB pixels into a shared-memory segment and
+only send its name and the image shapes over the socket, so pixel data is never
+pickled; the worker maps the segment, builds the PIL images from it (one copy
+into PIL's own buffer) and returns the L2-normalized embeddings.
+
+Run one worker per host (or a few pinned to disjoint cores):
+
+    python inference_worker.py --socket /run/clip/inference.sock --threads 4 --cpus 0-3
+
+and point front-ends at it with INFERENCE_SOCKET (comma-separate several
+sockets to round-robin across a pool). INFERENCE_AUTHKEY, when set, must match
+on both sides. Front-ends retry the connection with backoff for up to
+INFERENCE_CONNECT_TIMEOUT seconds (default 30) while the worker is starting.
+
+Images are shrunk on the front-end before the copy, so their shortest side is at
+most INFERENCE_MAX_SIDE pixels (default 256; CLIP preprocessing resizes to 224
+anyway). A 12 MP photo then takes about 0.25 MB of shared memory instead of 36 MB.
+"""
+import argparse
+import itertools
+import os
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from PIL import Image
+from metrics import timed
+
+DEFAULT_SOCKET = "/tmp/clip-inference.sock"
+INFERENCE_AUTHKEY = os.environ.get("INFERENCE_AUTHKEY", "").encode() or None
+INFERENCE_CONNECT_TIMEOUT = float(os.environ.get("INFERENCE_CONNECT_TIMEOUT", "30"))
+INFERENCE_MAX_SIDE = int(os.environ.get("INFERENCE_MAX_SIDE", "256"))
+
+# --- Client side ---
+
+_local = threading.local()
+_round_robin = itertools.count()
+
+def _pick_address(addresses):
+    addresses = [a.strip() for a in addresses.split(",") if a.strip()]
+    return addresses[next(_round_robin) % len(addresses)]
+
+def _connection(addresses, connect_timeout=None):
+    """Reuse one connection per front-end thread"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or conn.closed:
+        deadline = time.monotonic() + (INFERENCE_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout)
+        delay = 0.25
+        while True:
+            address = _pick_address(addresses)
+            try:
+                conn = Client(address, family="AF_UNIX", authkey=INFERENCE_AUTHKEY)
+                break
+            except OSError as e:
+                # The worker binds its socket only once the model has loaded
+                if time.monotonic() + delay > deadline:
+                    raise RuntimeError(f"CLIP inference worker unavailable at {address}: {e}") from e
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+        _local.conn = conn
+    return conn
+
+def _request(addresses, message, connect_timeout=None):
+    conn = _connection(addresses, connect_timeout)
+    try:
+        conn.send(message)
+        reply = conn.recv()
+    except (OSError, EOFError) as e:
+        conn.close()
+        _local.conn = None
+        raise RuntimeError(f"CLIP inference worker connection lost: {e}") from e
+    if "error" in reply:
+        raise RuntimeError(f"CLIP inference worker error: {reply['error']}")
+    return reply
+
+# Downscale so the shortest side is at most max_side, keeping the aspect ratio
+def shrink_image(image, max_side=INFERENCE_MAX_SIDE):
+    width, height = image.size
+    scale = max_side / min(width, height)
+    if scale >= 1:
+        return image
+    return image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BICUBIC)
+
+# Encode PIL images through the shared worker
+def encode_remote(images, addresses, model_name=None, pretrained=None):
+    """Returns a float32 numpy array of shape (len(images), embedding_dim)"""
+    with timed("encode_remote_shrink"):
+        pixels = [np.asarray(shrink_image(image.convert("RGB")), dtype=np.uint8) for image in images]
+    shapes = [p.shape for p in pixels]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(p.nbytes for p in pixels)))
+    try:
+        offset = 0
+        for p in pixels:
+            np.ndarray(p.shape, dtype=np.uint8, buffer=shm.buf, offset=offset)[:] = p
+            offset += p.nbytes
+        with timed("encode_remote"):
+            reply = _request(addresses, {
+                "op": "encode", "shm": shm.name, "shapes": shapes,
+                "model_name": model_name, "pretrained": pretrained,
+            })
+        return reply["embeddings"]
+    finally:
+        shm.close()
+        shm.unlink()
+
+def ping(addresses, connect_timeout=None):
+    return _request(addresses, {"op": "ping"}, connect_timeout)
+
+# Exit status for container healthchecks: 0 once the worker answers a ping
+def healthcheck(addresses):
+    try:
+        ping(addresses, connect_timeout=0)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    return 0
+
+# --- Worker side ---
+
+def _encode_pixels(buffer, shapes, model_name, pretrained, model_lock):
+    import clip_utils
+    from PIL import Image
+
+    images = []
+    offset = 0
+    for shape in shapes:
+        view = np.ndarray(shape, dtype=np.uint8, buffer=buffer, offset=offset)
+        images.append(Image.fromarray(view))
+        offset += view.nbytes
+    with model_lock:
+        # Models other than the default are loaded on first request (e.g. after a cut-over)
+        model, preprocess = clip_utils.get_model(model_name, pretrained)
+        return clip_utils.encode_images(images, model, preprocess)
+
+def _encode_from_shm(message, model_lock):
+    shm = shared_memory.SharedMemory(name=message["shm"])
+    # The client owns the segment; stop this process's tracker from unlinking it
+    resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        return _encode_pixels(
+            shm.buf, message["shapes"], message.get("model_name"), message.get("pretrained"), model_lock
+        )
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass  # a failed encode's traceback may still reference the mapping
+
+def _serve_connection(conn, model_lock):
+    with conn:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if message.get("op") == "ping":
+                    conn.send({"ok": True, "pid": os.getpid()})
+                elif message.get("op") == "encode":
+                    conn.send({"embeddings": _encode_from_shm(message, model_lock)})
+                else:
+                    conn.send({"error": f"unknown op {message.get('op')!r}"})
+            except Exception as e:
+                conn.send({"error": str(e)})
+
+def _parse_cpus(spec):
+    cpus = set()
+    for part in spec.split(","):
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+def serve(address, threads=None, cpus=None):
+    import torch
+    import clip_utils
+    from PIL import Image
+
+    if cpus:
+        os.sched_setaffinity(0, _parse_cpus(cpus))
+    if threads:
+        torch.set_num_threads(threads)
+
+    model, preprocess = clip_utils.get_model()
+    model_lock = threading.Lock()
+    with model_lock:
+        clip_utils.encode_images([Image.new("RGB", (224, 224))], model, preprocess)  # warm-up
+
+    if os.path.exists(address):
+        os.unlink(address)
+    with Listener(address, family="AF_UNIX", authkey=INFERENCE_AUTHKEY) as listener:
+        print(f"CLIP inference worker {os.getpid()} serving {clip_utils.CLIP_MODEL_NAME} on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # Failed handshakes (e.g. wrong authkey) must not stop the worker
+                print(f"Rejected inference connection: {e}")
+                continue
+            threading.Thread(
+                target=_serve_connection, args=(conn, model_lock), daemon=True
+            ).start()
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared CLIP inference worker")
+    parser.add_argument("--socket", default=os.environ.get("INFERENCE_SOCKET", DEFAULT_SOCKET).split(",")[0])
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--cpus", default=None, help="CPU affinity, e.g. '0-3' or '0,2'")
+    parser.add_argument("--healthcheck", action="store_true", help="Ping the worker on --socket and exit")
+    args = parser.parse_args()
+    if args.healthcheck:
+        raise SystemExit(healthcheck(args.socket))
+    serve(args.socket, threads=args.threads, cpus=args.cpus)
+
+if __name__ == "__main__":
+    main()
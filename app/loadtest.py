@@ -0,0 +1,382 @@
+"""
+Load test for the HTTP API with a realistic mix of traffic.
+
+Worker threads each keep one persistent connection and issue requests back to
+back (closed loop) for a fixed duration, drawing each request from a weighted
+mix of:
+
+    upload    POST /products/ with a synthetic photo (encode + insert)
+    search    POST /search with a synthetic photo (encode + vector search)
+    barcode   GET /products/barcode/{barcode}, mostly hits on seeded barcodes
+    stats     GET /stats
+    suggest   POST /suggest, answered by the stub OpenAI server
+    streamlit GET /_stcore/health on the Streamlit server (--streamlit-url)
+
+The Streamlit UI talks to its server over a websocket session protocol that
+cannot be replayed as plain HTTP, so it is only checked for liveness while the
+API carries the encode and search load that the UI triggers.
+
+The report gives throughput, latency percentiles and error rates per request
+type and overall, and is also written as JSON for comparison across commits.
+
+Typical run against the docker-compose database (or any Postgres with pgvector
+reachable through the DB_* environment variables):
+
+    DB_PORT=5434 python loadtest.py seed --dbname fruits_load --products 100000
+    python loadtest.py stub-openai --port 8099 &
+    DB_PORT=5434 DB_NAME=fruits_load OPENAI_BASE_URL=http://localhost:8099/v1 OPENAI_API_KEY=stub \\
+        uvicorn api:app --port 8000 --workers 4
+    python loadtest.py run --url http://localhost:8000 --products 100000 --concurrency 32 --duration 60
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+import benchmark
+import db_utils
+
+DEFAULT_MIX = "search=6,barcode=2,stats=1,upload=1,suggest=1"
+BARCODE_MISS_RATE = 0.1
+MAX_ERROR_SAMPLES = 5
+
+def seeded_barcode(i):
+    return f"{9000000000000 + i:013d}"
+
+# --- Seeding ---
+
+# Create the database if needed, apply the schema and load a synthetic catalogue
+def seed(args):
+    benchmark.prepare_database(args.dbname, args.schema)
+    conn = db_utils.get_db_conn()
+    benchmark.reset_catalogue(conn)
+    started = time.perf_counter()
+    for start, chunk in benchmark.iter_chunks(args.products, args.seed):
+        rows = (
+            (f"LOAD-{start + i:08d}", f"Load product {start + i}", f"bench/{start + i:08d}.png", embedding,
+             seeded_barcode(start + i), None, f"load-{(start + i) % args.partitions}" if args.partitions > 1 else None)
+            for i, embedding in enumerate(chunk)
+        )
+        db_utils.bulk_insert_products(rows, conn=conn)
+    conn.close()
+    print(f"Seeded {args.products} products into {args.dbname} in {time.perf_counter() - started:.1f}s")
+
+# --- Stub OpenAI server ---
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers chat completions with a canned suggestion after a fixed delay"""
+
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-3.5-turbo",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "Name: Stub Apple\nCategory: Fruit\nDescription: A stub."},
+            }],
+            "usage": {"prompt_tokens": 40, "completion_tokens": 12, "total_tokens": 52},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def stub_openai(args):
+    StubOpenAIHandler.latency = args.latency_ms / 1000.0
+    server = ThreadingHTTPServer((args.host, args.port), StubOpenAIHandler)
+    print(f"Stub OpenAI server on http://{args.host}:{args.port}/v1 ({args.latency_ms:.0f} ms per completion)")
+    server.serve_forever()
+
+# --- Traffic ---
+
+class HttpClient:
+    """One keep-alive connection per worker, reopened after errors"""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.scheme, self.netloc, self.prefix = parts.scheme, parts.netloc, parts.path.rstrip("/")
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.conn is None:
+            connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            self.conn = connection_class(self.netloc, timeout=self.timeout)
+        try:
+            self.conn.request(method, self.prefix + path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except Exception:
+            self.conn.close()
+            self.conn = None
+            raise
+
+def multipart(fields, files):
+    """Encode form fields and (name, filename, content_type, data) files as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        if value is None:
+            continue
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content_type, data in files:
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n".encode()
+        )
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+# Smooth random JPEGs, sized and compressed roughly like phone photos of products
+def synthetic_photos(count, seed, size=(640, 480)):
+    rng = np.random.default_rng(seed)
+    photos = []
+    for _ in range(count):
+        blotches = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8))
+        buffer = io.BytesIO()
+        blotches.resize(size, Image.BILINEAR).save(buffer, format="JPEG", quality=85)
+        photos.append(buffer.getvalue())
+    return photos
+
+class Workload:
+    """
+    The request types and the data they draw from. Each returns
+    (client, method, path, body, headers, expected statuses); requests are built
+    before the clock starts, so only the round trip is measured.
+    """
+
+    def __init__(self, args):
+        # No fixed pool by default: a fresh photo per request, so search results cannot come from a cache
+        self.photos = synthetic_photos(args.photos, args.seed)
+        self.products = args.products
+        self.top_k = args.top_k
+        self.tenant = args.tenant
+        self.category = args.category
+        self.streamlit_url = args.streamlit_url
+
+    def _photo(self, rng):
+        if self.photos:
+            data = rng.choice(self.photos)
+        else:
+            data = synthetic_photos(1, rng.randrange(2 ** 32))[0]
+        return ("image", "photo.jpg", "image/jpeg", data)
+
+    def upload(self, rng):
+        body, headers = multipart(
+            {
+                "article_number": f"LT-{uuid.uuid4().hex[:12].upper()}",
+                "product_name": "Load test product",
+                "barcode": f"LT{rng.randrange(10 ** 11):011d}",
+                "tenant": self.tenant,
+                "category": self.category,
+            },
+            [self._photo(rng)],
+        )
+        return "api", "POST", "/products/", body, headers, (200,)
+
+    def search(self, rng):
+        body, headers = multipart(
+            {"top_k": self.top_k, "tenant": self.tenant, "category": self.category}, [self._photo(rng)]
+        )
+        return "api", "POST", "/search", body, headers, (200,)
+
+    def barcode(self, rng):
+        if self.products and rng.random() >= BARCODE_MISS_RATE:
+            return "api", "GET", f"/products/barcode/{seeded_barcode(rng.randrange(self.products))}", None, None, (200,)
+        return "api", "GET", f"/products/barcode/MISS{rng.randrange(10 ** 9)}", None, None, (404,)
+
+    def stats(self, rng):
+        return "api", "GET", "/stats", None, None, (200,)
+
+    def suggest(self, rng):
+        body, headers = multipart({"description": "Photo of a product on a shelf"}, [])
+        return "api", "POST", "/suggest", body, headers, (200,)
+
+    def streamlit(self, rng):
+        return "streamlit", "GET", "/_stcore/health", None, None, (200,)
+
+class Recorder:
+    """Thread-safe latency and error collection per request type"""
+
+    def __init__(self, record_after):
+        self.record_after = record_after
+        self.latencies = {}
+        self.errors = Counter()
+        self.error_samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, op, started, seconds, error=None):
+        if started < self.record_after:
+            return  # warm-up
+        with self._lock:
+            self.latencies.setdefault(op, []).append(seconds)
+            if error is not None:
+                self.errors[op] += 1
+                samples = self.error_samples.setdefault(op, Counter())
+                if error in samples or len(samples) < MAX_ERROR_SAMPLES:
+                    samples[error] += 1
+
+def _worker(index, args, workload, mix, recorder, deadline):
+    rng = random.Random(args.seed * 1000 + index)
+    clients = {
+        "api": HttpClient(args.url, args.timeout),
+        "streamlit": HttpClient(args.streamlit_url, args.timeout) if args.streamlit_url else None,
+    }
+    ops, weights = zip(*mix)
+    while time.monotonic() < deadline:
+        op = rng.choices(ops, weights)[0]
+        client_name, method, path, body, headers, expected = getattr(workload, op)(rng)
+        client = clients[client_name]
+        started = time.monotonic()
+        error = None
+        try:
+            status, response = client.request(method, path, body, headers)
+            if status not in expected:
+                error = f"HTTP {status}: {' '.join(response[:200].decode(errors='replace').split())[:120]}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        recorder.record(op, started, time.monotonic() - started, error)
+
+def parse_mix(spec, streamlit_url):
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if not hasattr(Workload, name) or name.startswith("_"):
+            raise SystemExit(f"Unknown request type {name!r} in --mix")
+        if name == "streamlit" and not streamlit_url:
+            raise SystemExit("--mix includes streamlit but --streamlit-url is not set")
+        if float(weight or 1) > 0:
+            mix.append((name, float(weight or 1)))
+    return mix
+
+def summarize(recorder, seconds):
+    report = {}
+    all_latencies = []
+    for op, latencies in sorted(recorder.latencies.items()):
+        all_latencies.extend(latencies)
+        errors = recorder.errors[op]
+        report[op] = dict(
+            benchmark.percentiles_ms(latencies), requests=len(latencies), errors=errors,
+            error_rate=errors / len(latencies), throughput_rps=len(latencies) / seconds,
+            error_samples=dict(recorder.error_samples.get(op, {})),
+        )
+    if all_latencies:
+        errors = sum(recorder.errors.values())
+        report["total"] = dict(
+            benchmark.percentiles_ms(all_latencies), requests=len(all_latencies), errors=errors,
+            error_rate=errors / len(all_latencies), throughput_rps=len(all_latencies) / seconds,
+        )
+    return report
+
+def run(args):
+    mix = parse_mix(args.mix, args.streamlit_url)
+    workload = Workload(args)
+    started = time.monotonic()
+    recorder = Recorder(record_after=started + args.warmup)
+    deadline = started + args.warmup + args.duration
+    print(f"Running {args.concurrency} workers for {args.warmup}s warm-up + {args.duration}s against {args.url}")
+    threads = [
+        threading.Thread(target=_worker, args=(i, args, workload, mix, recorder, deadline), daemon=True)
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = summarize(recorder, args.duration)
+    print(f"{'request':<10} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for op, row in report.items():
+        print(f"{op:<10} {row['requests']:>7} {row['throughput_rps']:>8.1f} {row['p50_ms']:>8.1f} "
+              f"{row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['error_rate']:>7.1%}")
+        for message, count in row.get("error_samples", {}).items():
+            print(f"    {count}x {message}")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "meta": {
+                "commit": benchmark.git_commit(),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "url": args.url,
+                "concurrency": args.concurrency,
+                "duration_seconds": args.duration,
+                "warmup_seconds": args.warmup,
+                "mix": dict(mix),
+                "photos": args.photos or "fresh per request",
+            },
+            "results": report,
+        }, f, indent=2)
+    print(f"Wrote {args.output}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the product search API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("seed", help="Create a database with a synthetic catalogue")
+    p.add_argument("--dbname", default=os.environ.get("LOADTEST_DB_NAME", "fruits_load"))
+    p.add_argument("--schema", default=benchmark.DEFAULT_SCHEMA, help="Path to db/init.sql")
+    p.add_argument("--products", type=int, default=10000)
+    p.add_argument("--partitions", type=int, default=1, help="Spread products over this many categories")
+    p.add_argument("--seed", type=int, default=42)
+    p.set_defaults(func=seed)
+
+    p = commands.add_parser("stub-openai", help="Serve canned chat completions for /suggest")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--latency-ms", type=float, default=300.0, help="Simulated completion latency")
+    p.set_defaults(func=stub_openai)
+
+    p = commands.add_parser("run", help="Replay a request mix and report throughput and latency")
+    p.add_argument("--url", default="http://localhost:8000", help="API base URL")
+    p.add_argument("--streamlit-url", default=None, help="Streamlit base URL, for the streamlit health check")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="Comma-separated request=weight pairs")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--duration", type=float, default=60.0, help="Measured seconds")
+    p.add_argument("--warmup", type=float, default=5.0, help="Unmeasured seconds before the measurement")
+    p.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout in seconds")
+    p.add_argument("--products", type=int, default=10000, help="Seeded catalogue size, for barcode lookups")
+    p.add_argument("--photos", type=int, default=0,
+                   help="Distinct synthetic photos to cycle through; 0 sends a fresh photo with every request "
+                        "so repeated searches cannot be served from the result cache")
+    p.add_argument("--top-k", type=int, default=3)
+    p.add_argument("--tenant", default=None, help="Store filter/owner for searches and uploads")
+    p.add_argument("--category", default=None, help="Category filter/owner for searches and uploads")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--output", default=f"loadtest-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json")
+    p.set_defaults(func=run)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
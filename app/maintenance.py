@@ -0,0 +1,209 @@
+"""
+Set-based maintenance operations for uploaded images and product records.
+
+A cleanup runs as a background job in two phases:
+
+1. plan   - work out which product rows and image files to remove
+            (streaming the table with a server-side cursor and checking
+            files in parallel)
+2. execute - delete all planned rows with one `DELETE ... WHERE id = ANY(...)`
+             in a single transaction, then remove the files in parallel
+
+Rows are deleted before their files so the table never points at an image that
+has already gone. Progress is exposed through `MaintenanceJob.progress()` so
+the UI can poll it without blocking a request.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from db_utils import get_db_conn, bump_catalogue_version
+from metrics import timed, execute_query
+
+FILE_WORKERS = int(os.environ.get("MAINTENANCE_FILE_WORKERS", "16"))
+SCAN_BATCH_SIZE = 10000
+MAX_REPORTED_ERRORS = 20
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+class CleanupPlan:
+    """Product ids and file paths a cleanup will remove"""
+
+    def __init__(self, description, product_ids=(), file_paths=()):
+        self.description = description
+        self.product_ids = list(product_ids)
+        self.file_paths = list(file_paths)
+
+# --- Planners ---
+
+def _existing_flags(paths, pool):
+    return list(pool.map(os.path.exists, paths))
+
+# Rows whose image file no longer exists
+def plan_orphaned_records(job=None):
+    conn = get_db_conn()
+    orphaned = []
+    scanned = 0
+    try:
+        cur = conn.cursor(name="orphan_scan")  # server-side cursor: bounded memory
+        cur.itersize = SCAN_BATCH_SIZE
+        execute_query(cur, "maintenance_orphan_scan", "SELECT id, image_path FROM products WHERE image_path IS NOT NULL")
+        with ThreadPoolExecutor(max_workers=FILE_WORKERS) as pool:
+            while True:
+                rows = cur.fetchmany(SCAN_BATCH_SIZE)
+                if not rows:
+                    break
+                flags = _existing_flags([path for _, path in rows], pool)
+                orphaned.extend(product_id for (product_id, _), exists in zip(rows, flags) if not exists)
+                scanned += len(rows)
+                if job:
+                    job.set_status(f"Scanned {scanned} records, {len(orphaned)} orphaned")
+        cur.close()
+    finally:
+        conn.close()
+    return CleanupPlan("Clean up orphaned records", product_ids=orphaned)
+
+# Given image files plus every product row that points at them
+def plan_remove_files(file_paths, job=None):
+    file_paths = list(file_paths)
+    conn = get_db_conn()
+    try:
+        cur = conn.cursor()
+        execute_query(cur, "maintenance_rows_for_files", "SELECT id FROM products WHERE image_path = ANY(%s)", (file_paths,))
+        product_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+    finally:
+        conn.close()
+    return CleanupPlan(f"Remove {len(file_paths)} image(s)", product_ids=product_ids, file_paths=file_paths)
+
+# All image files under the upload folder plus their product rows
+def plan_remove_all_uploads(upload_folder, job=None):
+    file_paths = []
+    for root, dirs, filenames in os.walk(upload_folder):
+        for filename in filenames:
+            file_paths.append(os.path.join(root, filename))
+        if job:
+            job.set_status(f"Found {len(file_paths)} files")
+    plan = plan_remove_files(file_paths, job)
+    plan.description = "Remove all uploaded images"
+    return plan
+
+# --- Execution ---
+
+def delete_products(product_ids):
+    """Delete rows by id in one transaction; returns the number deleted"""
+    if not product_ids:
+        return 0
+    conn = get_db_conn()
+    try:
+        cur = conn.cursor()
+        execute_query(cur, "maintenance_delete_products", "DELETE FROM products WHERE id = ANY(%s)", (list(product_ids),))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bump_catalogue_version()
+    return deleted
+
+class MaintenanceJob:
+    """Background plan-and-execute cleanup with pollable progress"""
+
+    def __init__(self, planner, *args):
+        self.id = uuid.uuid4().hex
+        self.planner = planner
+        self.args = args
+        self.state = "pending"  # pending -> planning -> deleting_rows -> removing_files -> done | failed
+        self.status = ""
+        self.description = ""
+        self.rows_planned = 0
+        self.rows_deleted = 0
+        self.files_planned = 0
+        self.files_removed = 0
+        self.errors = []
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"maintenance-{self.id[:8]}", daemon=True)
+
+    def set_status(self, status):
+        with self._lock:
+            self.status = status
+
+    def _record_error(self, message):
+        with self._lock:
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append(message)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already gone, which is the goal
+        except OSError as e:
+            self._record_error(f"Could not remove {path}: {e}")
+            return
+        with self._lock:
+            self.files_removed += 1
+
+    def _run(self):
+        self.started_at = time.time()
+        try:
+            self.state = "planning"
+            with timed("maintenance_plan"):
+                plan = self.planner(*self.args, job=self)
+            self.description = plan.description
+            self.rows_planned = len(plan.product_ids)
+            self.files_planned = len(plan.file_paths)
+
+            self.state = "deleting_rows"
+            self.set_status(f"Deleting {self.rows_planned} database records")
+            with timed("maintenance_delete_rows"):
+                self.rows_deleted = delete_products(plan.product_ids)
+
+            self.state = "removing_files"
+            self.set_status(f"Removing {self.files_planned} files")
+            with timed("maintenance_remove_files"), ThreadPoolExecutor(max_workers=FILE_WORKERS) as pool:
+                list(pool.map(self._remove_file, plan.file_paths))
+
+            self.state = "done"
+            self.set_status(f"Deleted {self.rows_deleted} records and {self.files_removed} files")
+        except Exception as e:
+            self.state = "failed"
+            self.set_status(f"Failed: {e}")
+        finally:
+            self.finished_at = time.time()
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed")
+
+    def progress(self):
+        """Fraction of the work completed, between 0.0 and 1.0"""
+        if self.state == "done":
+            return 1.0
+        if self.state in ("pending", "planning") or not (self.rows_planned or self.files_planned):
+            return 0.0
+        total = self.rows_planned + self.files_planned
+        return min(1.0, (self.rows_deleted + self.files_removed) / total)
+
+# Start a background cleanup job; only one runs at a time per process
+def start_job(planner, *args):
+    with _jobs_lock:
+        for job in _jobs.values():
+            if not job.finished:
+                raise RuntimeError(f"A maintenance job is already running: {job.description or job.state}")
+        job = MaintenanceJob(planner, *args)
+        _jobs[job.id] = job
+    job._thread.start()
+    return job
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
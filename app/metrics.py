@@ -0,0 +1,217 @@
+"""
+In-process timing instrumentation with Prometheus-style exposition.
+
+Hot paths wrap their work in `timed("stage")` and SQL goes through
+`execute_query()`, which feed histograms and counters kept in this process.
+`render_prometheus()` produces the text format served by the FastAPI
+`/metrics` endpoint and `snapshot()` feeds the Streamlit admin panel.
+
+Set SLOW_QUERY_MS to log every SQL query slower than that many milliseconds.
+
+Histograms and counters live in each process. When several processes serve the
+same /metrics endpoint (uvicorn --workers N), set METRICS_DIR to a directory
+shared by them: every process then writes its metrics there (at most once per
+METRICS_FLUSH_SECONDS, default 1) and render_prometheus() sums all of them, so
+any worker answers a scrape with the totals. Files of exited workers are kept,
+so counters never go backwards; use a directory that is emptied when the
+service restarts (e.g. under /tmp in the container).
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger("products_similarity.metrics")
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0"))  # 0 disables slow-query logging
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "1"))
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> {"buckets": [...], "count": n, "sum": s}
+_counters = {}    # (name, labels) -> value
+_help = {}
+_slow_queries = deque(maxlen=50)
+_last_flush = [0.0]
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+# Record one observation (in seconds) into a histogram
+def observe(name, value, help_text="", **labels):
+    key = _key(name, labels)
+    with _lock:
+        _help.setdefault(name, (help_text, "histogram"))
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * len(DEFAULT_BUCKETS), "count": 0, "sum": 0.0}
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["count"] += 1
+        hist["sum"] += value
+    _maybe_flush()
+
+# Increment a counter
+def inc(name, amount=1, help_text="", **labels):
+    key = _key(name, labels)
+    with _lock:
+        _help.setdefault(name, (help_text, "counter"))
+        _counters[key] = _counters.get(key, 0) + amount
+    _maybe_flush()
+
+# Time a block of work as a named stage
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("stage_errors_total", help_text="Hot-path stages that raised", stage=stage)
+        raise
+    finally:
+        observe("stage_duration_seconds", time.perf_counter() - started,
+                help_text="Duration of hot-path stages", stage=stage)
+
+# Execute a SQL statement on a cursor with timing and slow-query logging
+def execute_query(cur, query_name, sql, params=None):
+    started = time.perf_counter()
+    try:
+        cur.execute(sql, params)
+    except Exception:
+        inc("db_query_errors_total", help_text="SQL queries that raised", query=query_name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("db_query_duration_seconds", elapsed, help_text="Duration of SQL queries", query=query_name)
+        if SLOW_QUERY_MS and elapsed * 1000.0 >= SLOW_QUERY_MS:
+            logger.warning("Slow query %s took %.1f ms", query_name, elapsed * 1000.0)
+            with _lock:
+                _slow_queries.append({
+                    "query": query_name,
+                    "duration_ms": round(elapsed * 1000.0, 1),
+                    "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                })
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+# Write this process's metrics to METRICS_DIR for the other workers to aggregate
+def flush():
+    if METRICS_DIR is None:
+        return
+    with _lock:
+        state = {
+            "help": _help,
+            "histograms": [[name, labels, hist] for (name, labels), hist in _histograms.items()],
+            "counters": [[name, labels, value] for (name, labels), value in _counters.items()],
+        }
+        payload = json.dumps(state)
+        _last_flush[0] = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        f.write(payload)
+    os.replace(path + ".tmp", path)  # readers never see a partial file
+
+def _maybe_flush():
+    if METRICS_DIR is not None and time.monotonic() - _last_flush[0] >= METRICS_FLUSH_SECONDS:
+        flush()
+
+if METRICS_DIR is not None:
+    atexit.register(flush)
+
+# Sum the metrics of every process that wrote to METRICS_DIR
+def _aggregate():
+    flush()
+    help_texts, histograms, counters = {}, {}, {}
+    for filename in sorted(os.listdir(METRICS_DIR)):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue  # replaced or removed while reading
+        for name, (help_text, kind) in state["help"].items():
+            help_texts.setdefault(name, (help_text, kind))
+        for name, labels, hist in state["histograms"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            total = histograms.setdefault(key, {"buckets": [0] * len(DEFAULT_BUCKETS), "count": 0, "sum": 0.0})
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], hist["buckets"])]
+            total["count"] += hist["count"]
+            total["sum"] += hist["sum"]
+        for name, labels, value in state["counters"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+    return help_texts, histograms, counters
+
+# Render all metrics in the Prometheus text exposition format
+def render_prometheus():
+    """Totals over all workers when METRICS_DIR is set, else this process's metrics"""
+    if METRICS_DIR is not None:
+        help_texts, histograms, counters = _aggregate()
+    else:
+        with _lock:
+            help_texts, histograms, counters = dict(_help), dict(_histograms), dict(_counters)
+    lines = []
+    for name, (help_text, kind) in sorted(help_texts.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (series, labels), hist in sorted(histograms.items()):
+                if series != name:
+                    continue
+                for bound, count in zip(DEFAULT_BUCKETS, hist["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']:.6f}")
+        else:
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def _estimate_quantile(hist, q):
+    """Upper bucket bound containing the q-th observation"""
+    target = q * hist["count"]
+    for bound, count in zip(DEFAULT_BUCKETS, hist["buckets"]):
+        if count >= target:
+            return bound
+    return float("inf")
+
+# Summary rows for display: one per histogram series
+def snapshot():
+    rows = []
+    with _lock:
+        for (name, labels), hist in sorted(_histograms.items()):
+            if not hist["count"]:
+                continue
+            errors_name = "stage_errors_total" if name == "stage_duration_seconds" else "db_query_errors_total"
+            rows.append({
+                "metric": name.replace("_duration_seconds", ""),
+                "name": ",".join(str(v) for _, v in labels),
+                "count": hist["count"],
+                "errors": _counters.get((errors_name, labels), 0),
+                "mean_ms": round(hist["sum"] / hist["count"] * 1000.0, 2),
+                "p50_le_ms": _estimate_quantile(hist, 0.50) * 1000.0,
+                "p95_le_ms": _estimate_quantile(hist, 0.95) * 1000.0,
+            })
+        slow = list(_slow_queries)
+    return rows, slow
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _slow_queries.clear()
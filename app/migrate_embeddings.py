@@ -0,0 +1,466 @@
+"""
+Re-embedding pipeline for moving the catalogue to another CLIP model online.
+
+products.embedding always holds the serving embedding of the active model
+(embedding_models.is_active). Every other registered model keeps its
+embeddings in its own nullable products column (embedding_models.staging_column),
+so a candidate is fully staged before it serves. A migration runs alongside
+normal traffic:
+
+    register  add a candidate model, its embedding dimension and its staging column
+    backfill  re-encode stored images in small batches into the staging column
+    status    show backfill coverage per model
+    shadow    compare neighbours and barcode recall of the active and candidate models
+    cutover   make the candidate serve by swapping column names
+
+Each backfill batch is its own short transaction, so serving continues while it
+runs, and it can be stopped and resumed at any time. The cut-over loads the
+model and encodes rows added since the backfill without any lock, then blocks
+writes (reads continue) only to encode the last few stragglers, and finally
+renames the two columns and switches the active model. The renames are
+catalogue-only changes: they take an ACCESS EXCLUSIVE lock but do not touch the
+table data, so reads pause for milliseconds, not for a table rewrite. The old
+model's embeddings stay in its staging column, so cutting back over is a
+rollback. Per-partition ANN indexes follow their column too: build the
+candidate's on its staging column before the cut-over (partitions.py build-all
+--model-id), and they serve from the first query; the retired model's are dropped.
+
+Example:
+    python migrate_embeddings.py register --model ViT-L-14 --pretrained openai
+    python migrate_embeddings.py backfill --model-id ViT-L-14/openai --batch-size 32
+    python migrate_embeddings.py shadow --model-id ViT-L-14/openai --sample 200
+    python partitions.py build-all --model-id ViT-L-14/openai
+    python migrate_embeddings.py cutover --model-id ViT-L-14/openai
+"""
+import argparse
+import hashlib
+import time
+
+import numpy as np
+from PIL import Image
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import clip_utils
+from db_utils import get_db_conn, to_embedding_list
+from metrics import timed, execute_query
+
+def staging_column_name(model_id):
+    return "embedding_" + hashlib.md5(model_id.encode()).hexdigest()[:12]
+
+def get_model_row(cur, model_id):
+    """(model_id, model_name, pretrained, dim, staging_column, is_active)"""
+    execute_query(
+        cur, "migrate_get_model",
+        """
+        SELECT model_id, model_name, pretrained, dim, staging_column, is_active
+        FROM embedding_models WHERE model_id = %s
+        """,
+        (model_id,)
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise SystemExit(f"Unknown model {model_id!r}; run 'register' first")
+    return row
+
+def get_active_model_row(cur):
+    execute_query(cur, "migrate_get_active", "SELECT model_id FROM embedding_models WHERE is_active")
+    return get_model_row(cur, cur.fetchone()[0])
+
+def _column_dim(cur, column):
+    execute_query(
+        cur, "migrate_column_dim",
+        "SELECT atttypmod FROM pg_attribute WHERE attrelid = 'products'::regclass AND attname = %s AND NOT attisdropped",
+        (column,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def register(args):
+    model_id = args.model_id or f"{args.model}/{args.pretrained}"
+    model, preprocess = clip_utils.load_model(args.model, args.pretrained)
+    dim = clip_utils.encode_images([Image.new("RGB", (224, 224))], model, preprocess).shape[1]
+    column = staging_column_name(model_id)
+    conn = get_db_conn()
+    cur = conn.cursor()
+    try:
+        execute_query(
+            cur, "migrate_register",
+            """
+            INSERT INTO embedding_models (model_id, model_name, pretrained, dim, staging_column)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (model_id) DO UPDATE SET model_name = EXCLUDED.model_name,
+                pretrained = EXCLUDED.pretrained, dim = EXCLUDED.dim
+            RETURNING is_active, staging_column
+            """,
+            (model_id, args.model, args.pretrained, dim, column)
+        )
+        is_active, column = cur.fetchone()
+        if is_active:
+            raise SystemExit(f"{model_id} is the active model")
+        current_dim = _column_dim(cur, column)
+        if current_dim is None:
+            # Nullable with no default: a catalogue-only change, no table rewrite
+            execute_query(cur, "migrate_lock_timeout", "SET LOCAL lock_timeout = '5s'")
+            execute_query(
+                cur, "migrate_add_staging_column",
+                sql.SQL("ALTER TABLE products ADD COLUMN {} vector({})").format(sql.Identifier(column), sql.Literal(dim))
+            )
+        elif current_dim != dim:
+            raise SystemExit(f"Staging column {column} holds {current_dim}-dimensional embeddings, not {dim}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    print(f"Registered {model_id} ({dim} dimensions, staged in products.{column})")
+
+def _load_images(rows):
+    """Split (id, image_path) rows into loadable images and missing/unreadable ids"""
+    ids, images, missing = [], [], []
+    for product_id, image_path in rows:
+        try:
+            images.append(Image.open(image_path).convert("RGB"))
+            ids.append(product_id)
+        except OSError:
+            missing.append(product_id)
+    return ids, images, missing
+
+def encode_and_store(cur, column, rows, model, preprocess):
+    """Encode (id, image_path) rows into the staging column; returns the ids that could not be read"""
+    ids, images, missing = _load_images(rows)
+    if images:
+        embeddings = clip_utils.encode_images(images, model, preprocess)
+        with timed("migrate_store_batch"):
+            execute_values(
+                cur,
+                sql.SQL(
+                    "UPDATE products p SET {} = v.embedding FROM (VALUES %s) AS v(id, embedding) WHERE p.id = v.id"
+                ).format(sql.Identifier(column)),
+                [(product_id, to_embedding_list(e)) for product_id, e in zip(ids, embeddings)],
+                template="(%s, %s::vector)",
+            )
+    return missing
+
+def _missing_rows(cur, column, after_id, limit, query_name):
+    execute_query(
+        cur, query_name,
+        sql.SQL("SELECT id, image_path FROM products WHERE id > %s AND {} IS NULL ORDER BY id LIMIT %s").format(
+            sql.Identifier(column)
+        ),
+        (after_id, limit)
+    )
+    return cur.fetchall()
+
+# Encode every row missing from the column, one short transaction per batch
+def _fill_column(conn, cur, column, model, preprocess, batch_size, query_name, sleep=0.0, report=False):
+    """Returns (rows encoded, unreadable ids)"""
+    last_id, encoded, unreadable = 0, 0, []
+    started = time.perf_counter()
+    while True:
+        rows = _missing_rows(cur, column, last_id, batch_size, query_name)
+        if not rows:
+            break
+        unreadable += encode_and_store(cur, column, rows, model, preprocess)
+        conn.commit()
+        last_id = rows[-1][0]
+        encoded += len(rows)
+        if report:
+            rate = encoded / (time.perf_counter() - started)
+            print(f"Backfilled up to id {last_id}: {encoded} rows ({rate:.1f} rows/sec)")
+        if sleep:
+            time.sleep(sleep)  # leave CPU/DB headroom for live traffic
+    return encoded, unreadable
+
+def backfill(args):
+    conn = get_db_conn()
+    cur = conn.cursor()
+    _, model_name, pretrained, _, column, is_active = get_model_row(cur, args.model_id)
+    conn.commit()
+    if is_active:
+        raise SystemExit(f"{args.model_id} is the active model")
+    model, preprocess = clip_utils.load_model(model_name, pretrained)
+    _, unreadable = _fill_column(
+        conn, cur, column, model, preprocess, args.batch_size, "migrate_backfill_batch", args.sleep, report=True
+    )
+    cur.close()
+    conn.close()
+    if unreadable:
+        print(f"{len(unreadable)} products have missing or unreadable images (e.g. ids {unreadable[:10]}); "
+              "remove them with 'Sync Database with Files' before cutting over")
+    print("Backfill complete")
+
+def status(args):
+    conn = get_db_conn()
+    cur = conn.cursor()
+    execute_query(
+        cur, "migrate_status",
+        "SELECT model_id, dim, staging_column, is_active, activated_at FROM embedding_models ORDER BY created_at"
+    )
+    models = cur.fetchall()
+    execute_query(cur, "migrate_status_total", "SELECT COUNT(*) FROM products")
+    total = cur.fetchone()[0]
+    for model_id, dim, column, is_active, activated_at in models:
+        serving_column = "embedding" if is_active else column
+        if _column_dim(cur, serving_column) is None:
+            embedded = 0
+        else:
+            execute_query(
+                cur, "migrate_status_count",
+                sql.SQL("SELECT COUNT({}) FROM products").format(sql.Identifier(serving_column))
+            )
+            embedded = cur.fetchone()[0]
+        flag = "ACTIVE" if is_active else "      "
+        print(f"{flag} {model_id:<40} dim={dim:<5} backfilled={embedded}/{total}"
+              + (f" activated={activated_at:%Y-%m-%d %H:%M}" if activated_at else ""))
+    cur.close()
+    conn.close()
+
+def _neighbours(cur, query_name, query, params):
+    started = time.perf_counter()
+    execute_query(cur, query_name, query, params)
+    return [row[0] for row in cur.fetchall()], time.perf_counter() - started
+
+def shadow(args):
+    """Compare the active model with a candidate on a sample of backfilled products"""
+    conn = get_db_conn()
+    cur = conn.cursor()
+    _, _, _, _, column, is_active = get_model_row(cur, args.model_id)
+    if is_active:
+        raise SystemExit(f"{args.model_id} is the active model")
+    active_id = get_active_model_row(cur)[0]
+    candidate = sql.Identifier(column)
+    execute_query(
+        cur, "migrate_shadow_sample",
+        sql.SQL("SELECT id, barcode FROM products WHERE {} IS NOT NULL ORDER BY random() LIMIT %s").format(candidate),
+        (args.sample,)
+    )
+    sample = cur.fetchall()
+    if not sample:
+        raise SystemExit(f"No backfilled products for {args.model_id}; run 'backfill' first")
+
+    # Barcodes shared by several products give a ground truth for recall
+    execute_query(
+        cur, "migrate_shadow_barcodes",
+        """
+        SELECT barcode, array_agg(id) FROM products
+        WHERE barcode IS NOT NULL AND barcode <> ''
+        GROUP BY barcode HAVING COUNT(*) > 1
+        """
+    )
+    same_barcode = {barcode: set(ids) for barcode, ids in cur.fetchall()}
+
+    overlaps, old_recalls, new_recalls, old_times, new_times = [], [], [], [], []
+    for product_id, barcode in sample:
+        # Both sides search the same candidate set: products that have a candidate embedding
+        old_ids, old_time = _neighbours(
+            cur, "migrate_shadow_old",
+            sql.SQL("""
+            SELECT id FROM products
+            WHERE {candidate} IS NOT NULL AND id <> %s
+            ORDER BY embedding <=> (SELECT embedding FROM products WHERE id = %s)
+            LIMIT %s
+            """).format(candidate=candidate),
+            (product_id, product_id, args.top_k)
+        )
+        new_ids, new_time = _neighbours(
+            cur, "migrate_shadow_new",
+            sql.SQL("""
+            SELECT id FROM products
+            WHERE {candidate} IS NOT NULL AND id <> %s
+            ORDER BY {candidate} <=> (SELECT {candidate} FROM products WHERE id = %s)
+            LIMIT %s
+            """).format(candidate=candidate),
+            (product_id, product_id, args.top_k)
+        )
+        old_times.append(old_time)
+        new_times.append(new_time)
+        overlaps.append(len(set(old_ids) & set(new_ids)) / args.top_k)
+        relevant = same_barcode.get(barcode, set()) - {product_id}
+        if relevant:
+            old_recalls.append(len(relevant & set(old_ids)) / len(relevant))
+            new_recalls.append(len(relevant & set(new_ids)) / len(relevant))
+    cur.close()
+    conn.close()
+
+    print(f"Shadow comparison on {len(sample)} products, top-{args.top_k}")
+    print(f"  active    {active_id}: mean query {np.mean(old_times) * 1000:.1f} ms")
+    print(f"  candidate {args.model_id}: mean query {np.mean(new_times) * 1000:.1f} ms")
+    print(f"  neighbour overlap@{args.top_k}: {np.mean(overlaps):.3f}")
+    if old_recalls:
+        print(f"  same-barcode recall@{args.top_k} ({len(old_recalls)} queries): "
+              f"active={np.mean(old_recalls):.3f} candidate={np.mean(new_recalls):.3f}")
+    else:
+        print("  no products share a barcode, so recall cannot be measured")
+
+def cutover(args):
+    conn = get_db_conn()
+    cur = conn.cursor()
+    model_id, model_name, pretrained, dim, column, is_active = get_model_row(cur, model_id=args.model_id)
+    if is_active:
+        raise SystemExit(f"{model_id} is already active")
+    active_id, _, _, _, active_column, _ = get_active_model_row(cur)
+    conn.commit()
+
+    # Load the model and catch up on rows added since the backfill, without any lock
+    model, preprocess = clip_utils.load_model(model_name, pretrained)
+    while True:
+        encoded, unreadable = _fill_column(
+            conn, cur, column, model, preprocess, args.batch_size, "migrate_cutover_catch_up"
+        )
+        if unreadable:
+            raise SystemExit(f"Products {unreadable[:10]} have missing or unreadable images; "
+                             "remove them with 'Sync Database with Files' and retry")
+        if encoded <= args.batch_size:
+            break  # only a handful of new rows arrive per pass now
+
+    # Partitions served through an ANN index today should have one staged for the candidate
+    execute_query(
+        cur, "migrate_cutover_unstaged_indexes",
+        """
+        SELECT sp.tenant, sp.category FROM search_partitions sp
+        WHERE sp.index_name IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM staged_partition_indexes s
+            WHERE s.model_id = %s AND s.tenant = sp.tenant AND s.category = sp.category
+        )
+        ORDER BY sp.tenant, sp.category
+        """,
+        (model_id,)
+    )
+    unstaged = cur.fetchall()
+    conn.commit()
+    if unstaged and not args.without_indexes:
+        raise SystemExit(
+            f"{len(unstaged)} indexed partitions (e.g. {unstaged[0][0]}/{unstaged[0][1]}) have no index for "
+            f"{model_id}; build them first with: partitions.py build-all --model-id {model_id} "
+            "(or pass --without-indexes to serve them by exact scans until rebuilt)"
+        )
+
+    try:
+        execute_query(cur, "migrate_cutover_lock_timeout", "SET LOCAL lock_timeout = %s",
+                      (f"{int(args.lock_timeout * 1000)}ms",))
+        # Block writes (reads continue) while the last stragglers are encoded, in this transaction
+        execute_query(cur, "migrate_cutover_lock", "LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE")
+        last_id = 0
+        while True:
+            rows = _missing_rows(cur, column, last_id, args.batch_size, "migrate_cutover_stragglers")
+            if not rows:
+                break
+            if encode_and_store(cur, column, rows, model, preprocess):
+                raise SystemExit("A product added during the cut-over has an unreadable image; retry")
+            last_id = rows[-1][0]
+
+        execute_query(
+            cur, "migrate_cutover_retired_indexes",
+            "SELECT index_name FROM search_partitions WHERE index_name IS NOT NULL"
+        )
+        retired_indexes = [row[0] for row in cur.fetchall()]
+
+        # Catalogue-only swap: reads pause for the renames, not for a table rewrite. Indexes
+        # follow their column, so the staged partition indexes arrive on embedding built.
+        execute_query(cur, "migrate_cutover_nullable", "ALTER TABLE products ALTER COLUMN embedding DROP NOT NULL")
+        execute_query(
+            cur, "migrate_cutover_retire",
+            sql.SQL("ALTER TABLE products RENAME COLUMN embedding TO {}").format(sql.Identifier(active_column))
+        )
+        execute_query(
+            cur, "migrate_cutover_promote",
+            sql.SQL("ALTER TABLE products RENAME COLUMN {} TO embedding").format(sql.Identifier(column))
+        )
+        # Trigger column lists are stored by column number: point this one at the new embedding
+        execute_query(
+            cur, "migrate_cutover_catalogue_trigger",
+            """
+            DROP TRIGGER IF EXISTS trg_catalogue_version_products ON products;
+            CREATE TRIGGER trg_catalogue_version_products
+                AFTER INSERT OR DELETE OR TRUNCATE
+                   OR UPDATE OF article_number, product_name, image_path, embedding, barcode, tenant, category
+                ON products
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_catalogue_version();
+            """
+        )
+        # The retired model's indexes would only slow down writes; the table is locked already
+        for name in retired_indexes:
+            execute_query(
+                cur, "migrate_cutover_drop_retired_index",
+                sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(name))
+            )
+        execute_query(
+            cur, "migrate_cutover_clear_partition_indexes",
+            """
+            UPDATE search_partitions
+            SET index_name = NULL, index_type = NULL, indexed_rows = NULL, build_seconds = NULL, built_at = NULL
+            """
+        )
+        execute_query(
+            cur, "migrate_cutover_promote_partition_indexes",
+            """
+            UPDATE search_partitions sp
+            SET index_name = s.index_name, index_type = s.index_type, indexed_rows = s.indexed_rows,
+                build_seconds = s.build_seconds, built_at = s.built_at
+            FROM staged_partition_indexes s
+            WHERE s.model_id = %s AND s.tenant = sp.tenant AND s.category = sp.category
+            """,
+            (model_id,)
+        )
+        execute_query(
+            cur, "migrate_cutover_clear_staged_indexes",
+            "DELETE FROM staged_partition_indexes WHERE model_id = %s",
+            (model_id,)
+        )
+        execute_query(cur, "migrate_cutover_deactivate", "UPDATE embedding_models SET is_active = FALSE WHERE is_active")
+        execute_query(
+            cur, "migrate_cutover_activate",
+            "UPDATE embedding_models SET is_active = TRUE, activated_at = NOW() WHERE model_id = %s",
+            (model_id,)
+        )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    print(f"Cut over from {active_id} to {model_id}; dropped {len(retired_indexes)} partition indexes of {active_id}")
+    print(f"Roll back with: partitions.py build-all --model-id {active_id}, then cutover --model-id {active_id}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Migrate the catalogue to another embedding model")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("register", help="Register a candidate model")
+    p.add_argument("--model", required=True, help="open_clip architecture, e.g. ViT-L-14")
+    p.add_argument("--pretrained", required=True, help="pretrained tag or local checkpoint path")
+    p.add_argument("--model-id", help="Identifier to store (default: MODEL/PRETRAINED)")
+    p.set_defaults(func=register)
+
+    p = sub.add_parser("backfill", help="Re-encode stored images for a candidate model")
+    p.add_argument("--model-id", required=True)
+    p.add_argument("--batch-size", type=int, default=32)
+    p.add_argument("--sleep", type=float, default=0.0, help="Pause between batches, in seconds")
+    p.set_defaults(func=backfill)
+
+    p = sub.add_parser("status", help="Show backfill coverage per model")
+    p.set_defaults(func=status)
+
+    p = sub.add_parser("shadow", help="Compare the active model with a candidate")
+    p.add_argument("--model-id", required=True)
+    p.add_argument("--sample", type=int, default=200)
+    p.add_argument("--top-k", type=int, default=10)
+    p.set_defaults(func=shadow)
+
+    p = sub.add_parser("cutover", help="Make a candidate model active by swapping columns")
+    p.add_argument("--model-id", required=True)
+    p.add_argument("--batch-size", type=int, default=32)
+    p.add_argument("--without-indexes", action="store_true",
+                   help="Cut over even if indexed partitions have no staged index for the candidate")
+    p.add_argument("--lock-timeout", type=float, default=5.0,
+                   help="Give up (and retry later) if the table lock is not granted within this many seconds")
+    p.set_defaults(func=cutover)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
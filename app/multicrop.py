@@ -0,0 +1,109 @@
+"""
+Multi-crop search for shelf or basket photos that show several products.
+
+The photo is split into regions (a grid, or overlapping sliding windows), all
+regions are encoded in one forward pass, searched with one batched SQL query
+(find_similar_batch) and the per-region top-k lists are merged so each product
+appears once with its best score and the regions it matched.
+
+The photo is first downscaled just enough that the smallest region still covers
+the model input, and every crop is then shrunk to that size, so a 12 MP shelf
+photo is encoded from a few hundred kilobytes of pixels instead of >100 MB.
+"""
+import math
+
+from PIL import Image
+
+import clip_utils
+from db_utils import find_similar_batch
+from inference_worker import INFERENCE_MAX_SIDE, shrink_image
+from metrics import timed
+
+# Region boxes for an image of the given size
+def region_boxes(width, height, mode="grid", grid=2, window=0.5, stride=0.25, include_full=True):
+    """
+    Args:
+        width, height: Image size in pixels
+        mode: "grid" for grid x grid tiles, "sliding" for overlapping windows
+        grid: Tiles per side in grid mode
+        window: Window side as a fraction of the image side in sliding mode
+        stride: Step between windows as a fraction of the image side in sliding mode
+        include_full: Also include the whole image as the first region
+    """
+    if mode == "grid":
+        fractions = [(col / grid, row / grid, 1 / grid) for row in range(grid) for col in range(grid)]
+    elif mode == "sliding":
+        steps = []
+        position = 0.0
+        while position + window <= 1.0 + 1e-9:
+            steps.append(position)
+            position += stride
+        fractions = [(x, y, window) for y in steps for x in steps]
+    else:
+        raise ValueError(f"Unknown crop mode {mode!r}")
+
+    boxes = [(0, 0, width, height)] if include_full else []
+    for x, y, size in fractions:
+        boxes.append((
+            round(x * width), round(y * height),
+            min(width, round((x + size) * width)), min(height, round((y + size) * height)),
+        ))
+    return boxes
+
+# Split an image into (box, crop) regions; options as for region_boxes()
+def crop_regions(image, **options):
+    return [(box, image.crop(box)) for box in region_boxes(image.width, image.height, **options)]
+
+# Merge per-region result lists into one ranking
+def merge_region_results(region_results, top_k=3):
+    """
+    Keeps each product once, with its best similarity across regions
+
+    Returns:
+        A list of (article_number, product_name, image_path, similarity, region_indexes, best_region)
+        sorted by similarity, at most top_k long; best_region is the region that scored the
+        best similarity
+    """
+    merged = {}
+    for region_index, results in enumerate(region_results):
+        for article_number, product_name, image_path, similarity in results:
+            entry = merged.get(article_number)
+            if entry is None:
+                merged[article_number] = [article_number, product_name, image_path, similarity, [region_index],
+                                          region_index]
+            else:
+                if similarity > entry[3]:
+                    entry[3] = similarity
+                    entry[5] = region_index
+                entry[4].append(region_index)
+    ranked = sorted(merged.values(), key=lambda entry: entry[3], reverse=True)
+    return [tuple(entry) for entry in ranked[:top_k]]
+
+# Downscale the photo so that its smallest crop region keeps about max_side pixels on its short side
+def _working_image(image, mode="grid", grid=2, window=0.5, max_side=INFERENCE_MAX_SIDE, **crop_options):
+    """Returns (image, scale) where scale maps original coordinates to the returned image"""
+    smallest = 1 / grid if mode == "grid" else window
+    scale = math.ceil(max_side / smallest) / min(image.size)
+    if scale >= 1:
+        return image, 1.0
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.BICUBIC), scale
+
+# Search all regions of an image with one encode pass and one SQL round trip
+def search_regions(image, top_k=3, per_region_k=3, min_similarity=0.0,
+                   model_name=None, pretrained=None, tenant=None, category=None, model_id=None, **crop_options):
+    """
+    Returns (boxes, merged results) where results reference regions by index into boxes,
+    given in the coordinates of the original image; raises EmbeddingModelChanged when
+    model_id is given and no longer active
+    """
+    with timed("multicrop_crop"):
+        boxes = region_boxes(image.width, image.height, **crop_options)
+        working, scale = _working_image(image, **crop_options)
+        crops = [shrink_image(working.crop(tuple(round(v * scale) for v in box))) for box in boxes]
+    embeddings = clip_utils.embed_images(crops, model_name, pretrained)
+    region_results = find_similar_batch(
+        embeddings, top_k=per_region_k, min_similarity=min_similarity, tenant=tenant, category=category,
+        model_id=model_id
+    )
+    return boxes, merge_region_results(region_results, top_k=top_k)
@@ -0,0 +1,285 @@
+"""
+Per-partition ANN indexes for store/category-sharded similarity search.
+
+Products carry a tenant (store) and a category; every (tenant, category) pair
+is a search partition, registered in `search_partitions` by a trigger on
+insert. Instead of one ANN index over the whole catalogue, each large partition
+gets its own partial index:
+
+    CREATE INDEX ... ON products USING hnsw (embedding vector_cosine_ops)
+    WHERE tenant = '<tenant>' AND category = '<category>'
+
+find_similar() (db_utils.py) prunes to the partitions matching a filter and
+searches each indexed one separately, so a filtered search only walks that
+partition's graph and an unfiltered one merges the per-partition top-k. Small
+partitions are fine without an index; they share a single branch, a plain scan
+(via the (tenant, category) btree when filtered).
+
+Indexes are built with CREATE INDEX CONCURRENTLY, so searches and inserts keep
+running while a partition is (re)indexed.
+
+Indexes belong to an embedding model. By default they are built on the active
+model's products.embedding; with --model-id they are built on a candidate
+model's staging column (see migrate_embeddings.py) and recorded in
+staged_partition_indexes. A cut-over renames the columns, so the candidate's
+indexes arrive on products.embedding already built, and the retired model's
+are dropped. Build them after the backfill, so the graph is built in one pass.
+
+Usage:
+    python partitions.py list [--model-id ViT-L-14/openai]
+    python partitions.py build --tenant store-1 --category dairy [--type ivfflat]
+    python partitions.py build-all --min-rows 5000 [--model-id ViT-L-14/openai]
+    python partitions.py drop --tenant store-1 --category dairy
+"""
+import argparse
+import hashlib
+import time
+
+from psycopg2 import sql
+
+from db_utils import get_db_conn, get_search_partitions
+from metrics import timed, execute_query
+
+DEFAULT_MIN_ROWS = 5000
+
+# Deterministic index name; tenant/category may contain anything, so hash them
+def index_name(tenant, category, model_id):
+    digest = hashlib.md5(f"{tenant}\x00{category}\x00{model_id}".encode()).hexdigest()[:16]
+    return f"idx_part_{digest}"
+
+# The model whose embeddings are indexed and the column holding them
+def index_target(cur, model_id=None):
+    """(model_id, column, is_active); the active model when model_id is None"""
+    execute_query(
+        cur, "partition_index_target",
+        """
+        SELECT model_id, staging_column, is_active FROM embedding_models
+        WHERE model_id = %s OR (%s IS NULL AND is_active)
+        """,
+        (model_id, model_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise ValueError(f"Unknown embedding model {model_id!r}")
+    model_id, staging_column, is_active = row
+    return model_id, "embedding" if is_active else staging_column, is_active
+
+# Every partition with its current row count and index state for a model
+def list_partitions(model_id=None):
+    conn = get_db_conn()
+    try:
+        cur = conn.cursor()
+        model_id, _, is_active = index_target(cur, model_id)
+        if is_active:
+            execute_query(
+                cur, "list_partitions",
+                """
+                SELECT sp.tenant, sp.category, count(p.id), sp.index_name, sp.index_type,
+                       sp.indexed_rows, sp.build_seconds, sp.built_at
+                FROM search_partitions sp
+                LEFT JOIN products p ON p.tenant = sp.tenant AND p.category = sp.category
+                GROUP BY sp.tenant, sp.category
+                ORDER BY sp.tenant, sp.category
+                """
+            )
+        else:
+            execute_query(
+                cur, "list_staged_partitions",
+                """
+                SELECT sp.tenant, sp.category, count(p.id), s.index_name, s.index_type,
+                       s.indexed_rows, s.build_seconds, s.built_at
+                FROM search_partitions sp
+                LEFT JOIN staged_partition_indexes s
+                    ON s.model_id = %s AND s.tenant = sp.tenant AND s.category = sp.category
+                LEFT JOIN products p ON p.tenant = sp.tenant AND p.category = sp.category
+                GROUP BY sp.tenant, sp.category, s.index_name, s.index_type,
+                         s.indexed_rows, s.build_seconds, s.built_at
+                ORDER BY sp.tenant, sp.category
+                """,
+                (model_id,)
+            )
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+    return rows
+
+def _partition_rows(cur, tenant, category):
+    execute_query(
+        cur, "partition_rows",
+        "SELECT count(*) FROM products WHERE tenant = %s AND category = %s",
+        (tenant, category)
+    )
+    return cur.fetchone()[0]
+
+# (Re)build the partial ANN index of one partition
+def build_partition_index(tenant, category, index_type="hnsw", model_id=None):
+    """Returns (index_name, rows_indexed, build_seconds); model_id defaults to the active model"""
+    conn = get_db_conn()
+    conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    try:
+        cur = conn.cursor()
+        model_id, column, is_active = index_target(cur, model_id)
+        name = index_name(tenant, category, model_id)
+        rows = _partition_rows(cur, tenant, category)
+        if index_type == "ivfflat":
+            method = sql.SQL("ivfflat ({} vector_cosine_ops) WITH (lists = {})").format(
+                sql.Identifier(column), sql.Literal(max(1, int(rows ** 0.5)))
+            )
+        elif index_type == "hnsw":
+            method = sql.SQL("hnsw ({} vector_cosine_ops)").format(sql.Identifier(column))
+        else:
+            raise ValueError(f"Unknown index type {index_type!r}")
+
+        started = time.perf_counter()
+        with timed("partition_index_build"):
+            cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+            cur.execute(
+                sql.SQL(
+                    "CREATE INDEX CONCURRENTLY {} ON products USING {} WHERE tenant = {} AND category = {}"
+                ).format(sql.Identifier(name), method, sql.Literal(tenant), sql.Literal(category))
+            )
+        seconds = time.perf_counter() - started
+        if is_active:
+            # A differently named index (e.g. from before names included the model) is replaced
+            execute_query(
+                cur, "current_partition_index",
+                "SELECT index_name FROM search_partitions WHERE tenant = %s AND category = %s",
+                (tenant, category)
+            )
+            current = cur.fetchone()
+            if current and current[0] and current[0] != name:
+                cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(current[0])))
+            execute_query(
+                cur, "record_partition_index",
+                """
+                UPDATE search_partitions
+                SET index_name = %s, index_type = %s, indexed_rows = %s, build_seconds = %s, built_at = now()
+                WHERE tenant = %s AND category = %s
+                """,
+                (name, index_type, rows, seconds, tenant, category)
+            )
+        else:
+            execute_query(
+                cur, "record_staged_partition_index",
+                """
+                INSERT INTO staged_partition_indexes
+                    (model_id, tenant, category, index_name, index_type, indexed_rows, build_seconds, built_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+                ON CONFLICT (model_id, tenant, category) DO UPDATE SET
+                    index_name = EXCLUDED.index_name, index_type = EXCLUDED.index_type,
+                    indexed_rows = EXCLUDED.indexed_rows, build_seconds = EXCLUDED.build_seconds,
+                    built_at = EXCLUDED.built_at
+                """,
+                (model_id, tenant, category, name, index_type, rows, seconds)
+            )
+        cur.close()
+    finally:
+        conn.close()
+    get_search_partitions(refresh=True)
+    return name, rows, seconds
+
+# Drop the partial index of one partition; its searches fall back to a scan
+def drop_partition_index(tenant, category, model_id=None):
+    conn = get_db_conn()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        model_id, _, is_active = index_target(cur, model_id)
+        name = index_name(tenant, category, model_id)
+        if is_active:
+            execute_query(
+                cur, "current_partition_index",
+                "SELECT index_name FROM search_partitions WHERE tenant = %s AND category = %s",
+                (tenant, category)
+            )
+            current = cur.fetchone()
+            name = current[0] if current and current[0] else name
+        cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+        if is_active:
+            execute_query(
+                cur, "clear_partition_index",
+                """
+                UPDATE search_partitions
+                SET index_name = NULL, index_type = NULL, indexed_rows = NULL, build_seconds = NULL, built_at = NULL
+                WHERE tenant = %s AND category = %s
+                """,
+                (tenant, category)
+            )
+        else:
+            execute_query(
+                cur, "clear_staged_partition_index",
+                "DELETE FROM staged_partition_indexes WHERE model_id = %s AND tenant = %s AND category = %s",
+                (model_id, tenant, category)
+            )
+        cur.close()
+    finally:
+        conn.close()
+    get_search_partitions(refresh=True)
+    return name
+
+# Index every partition with at least min_rows products that has no index yet
+def build_all(min_rows=DEFAULT_MIN_ROWS, index_type="hnsw", rebuild=False, model_id=None):
+    built = []
+    for tenant, category, rows, current_index, *_ in list_partitions(model_id):
+        if rows < min_rows or (current_index and not rebuild):
+            continue
+        built.append((tenant, category) + build_partition_index(tenant, category, index_type, model_id))
+    return built
+
+def cmd_list(args):
+    rows = list_partitions(args.model_id)
+    if not rows:
+        print("No partitions registered")
+        return
+    for tenant, category, count, name, index_type, indexed_rows, seconds, built_at in rows:
+        index = f"{index_type} {name} ({indexed_rows} rows, {seconds:.1f}s, {built_at:%Y-%m-%d %H:%M})" if name else "no index"
+        print(f"{tenant}/{category}: {count} products, {index}")
+
+def cmd_build(args):
+    name, rows, seconds = build_partition_index(args.tenant, args.category, args.type, args.model_id)
+    print(f"Built {args.type} index {name} on {args.tenant}/{args.category}: {rows} rows in {seconds:.1f}s")
+
+def cmd_build_all(args):
+    built = build_all(args.min_rows, args.type, args.rebuild, args.model_id)
+    for tenant, category, name, rows, seconds in built:
+        print(f"Built {args.type} index {name} on {tenant}/{category}: {rows} rows in {seconds:.1f}s")
+    print(f"{len(built)} partition index(es) built")
+
+def cmd_drop(args):
+    print(f"Dropped {drop_partition_index(args.tenant, args.category, args.model_id)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage per-partition ANN indexes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="Show partitions and their indexes")
+    list_parser.set_defaults(func=cmd_list)
+
+    build = commands.add_parser("build", help="(Re)build one partition's index")
+    build.add_argument("--tenant", required=True)
+    build.add_argument("--category", required=True)
+    build.add_argument("--type", choices=["hnsw", "ivfflat"], default="hnsw")
+    build.set_defaults(func=cmd_build)
+
+    build_all_parser = commands.add_parser("build-all", help="Index every partition above a size threshold")
+    build_all_parser.add_argument("--min-rows", type=int, default=DEFAULT_MIN_ROWS)
+    build_all_parser.add_argument("--type", choices=["hnsw", "ivfflat"], default="hnsw")
+    build_all_parser.add_argument("--rebuild", action="store_true", help="Also rebuild existing indexes")
+    build_all_parser.set_defaults(func=cmd_build_all)
+
+    drop = commands.add_parser("drop", help="Drop one partition's index")
+    drop.add_argument("--tenant", required=True)
+    drop.add_argument("--category", required=True)
+    drop.set_defaults(func=cmd_drop)
+
+    for command in (list_parser, build, build_all_parser, drop):
+        command.add_argument("--model-id", default=None,
+                             help="Embedding model whose embeddings are indexed (default: the active model); "
+                                  "a candidate's indexes are staged for its cut-over")
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
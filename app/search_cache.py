@@ -0,0 +1,139 @@
+"""
+Result cache for repeated similarity searches.
+
+Entries are keyed by the query (a product id, or a hash of the query embedding),
+the embedding model, top_k, threshold, store/category filter and the catalogue
+version, with LRU eviction and a TTL. The catalogue version lives in the database
+and is bumped by every insert, update, delete or import of products, by model
+cut-overs and by partition index builds, from any process; each process follows
+it through LISTEN/NOTIFY (db_utils.catalogue_version). While the version cannot
+be followed, searches are not cached.
+
+Environment:
+    SEARCH_CACHE_SIZE  maximum number of cached result lists (default 1024, 0 disables)
+    SEARCH_CACHE_TTL   seconds an entry stays valid (default 60)
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import db_utils
+from metrics import inc, execute_query
+
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "60"))
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_results = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+def _lookup(key, compute):
+    version = db_utils.catalogue_version()
+    if version is None:
+        # Cannot tell when entries go stale: search without caching
+        inc("search_cache_misses_total", help_text="Similarity searches that missed the result cache")
+        return compute()
+    key = key + (version,)
+    results = _results.get(key)
+    if results is not None:
+        inc("search_cache_hits_total", help_text="Similarity searches served from the result cache")
+        return results
+    inc("search_cache_misses_total", help_text="Similarity searches that missed the result cache")
+    results = compute()
+    if results is not None:
+        _results.put(key, results)
+    return results
+
+def embedding_key(embedding):
+    """Stable hash of a query embedding"""
+    vector = np.asarray(db_utils.to_embedding_list(embedding), dtype=np.float32)
+    return hashlib.sha1(vector.tobytes()).hexdigest()
+
+# Cached find_similar() for an arbitrary query embedding
+def find_similar(embedding, top_k=3, min_similarity=0.0, tenant=None, category=None, model_id=None):
+    """Raises EmbeddingModelChanged when model_id is given and no longer active"""
+    return _lookup(
+        ("embedding", model_id, embedding_key(embedding), top_k, min_similarity, tenant, category),
+        lambda: db_utils.find_similar(
+            embedding, top_k=top_k, min_similarity=min_similarity, tenant=tenant, category=category,
+            model_id=model_id
+        ),
+    )
+
+# Cached find_similar() using a stored product's embedding as the query
+def find_similar_to_product(product_id, top_k=3, min_similarity=0.0, tenant=None, category=None, model_id=None):
+    """
+    Returns None when the product has no embedding. model_id is the caller's idea of
+    the active model and keys the cache; EmbeddingModelChanged is raised when it is stale.
+    """
+    def compute():
+        conn = db_utils.get_db_conn()
+        try:
+            cur = conn.cursor()
+            execute_query(
+                cur, "get_product_embedding",
+                """
+                SELECT p.embedding, m.model_id
+                FROM products p JOIN embedding_models m ON m.is_active
+                WHERE p.id = %s
+                """,
+                (product_id,)
+            )
+            row = cur.fetchone()
+            cur.close()
+            if not row or not row[0]:
+                return None
+            embedding, active_id = row
+            if model_id is not None and active_id != model_id:
+                raise db_utils.EmbeddingModelChanged(f"Embedding model {model_id} is no longer active")
+            # The stored embedding and the search must come from the same model
+            return db_utils.find_similar(
+                embedding, top_k=top_k, min_similarity=min_similarity, conn=conn, tenant=tenant,
+                category=category, model_id=active_id
+            )
+        finally:
+            conn.close()
+
+    return _lookup(("product", model_id, product_id, top_k, min_similarity, tenant, category), compute)
+
+def clear():
+    _results.clear()
@@ -1,152 +1,45 @@
 import streamlit as st
-import psycopg2
 import numpy as np
 from PIL import Image
-import torch
-import open_clip
 import os
 import uuid
 import re
 import shutil  # Add this import for file and folder removal
 from gpt_utils import generate_product_info
+from db_utils import get_db_conn, insert_product, get_product_by_barcode, EmbeddingModelChanged
+import db_utils
+import clip_utils
+import metrics
+import maintenance
+import multicrop
+import search_cache
 
 # Initialize session state for tracking uploads
 if 'session_uploads' not in st.session_state:
     st.session_state.session_uploads = 0
 
-# Database configuration
-DB_CONFIG = {
-    "host": os.environ.get("DB_HOST", "localhost"),
-    "port": int(os.environ.get("DB_PORT", 5432)),
-    "dbname": os.environ.get("DB_NAME", "fruits"),
-    "user": os.environ.get("DB_USER", "postgres"),
-    "password": os.environ.get("DB_PASSWORD", "postgres")
-}
-
-# Load CLIP model with caching
-@st.cache_resource
-def load_model():
-    # Revert to the old model configuration
-    model, _, preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained='openai')
-    return model, preprocess
-
-# Get DB connection
-def get_db_conn():
-    print("DB config being used:", DB_CONFIG)  # Debug print to show all DB params
-    # Extra debug: print each value separately
-    print("Host:", DB_CONFIG["host"])
-    print("Port:", DB_CONFIG["port"])
-    print("DB Name:", DB_CONFIG["dbname"])
-    print("User:", DB_CONFIG["user"])
-    print("Password:", repr(DB_CONFIG["password"]))
-    return psycopg2.connect(**DB_CONFIG)
-
-# Insert product into the DB
-def insert_product(article_number, product_name, image_path, embedding, barcode=None):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO products (article_number, product_name, image_path, embedding, barcode, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, now(), now())
-        """,
-        (article_number, product_name, image_path, embedding.tolist(), barcode)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# Find similar products - IMPROVED to show Top 3 with better similarity calculation
-def find_similar(embedding, top_k=3, min_similarity=0.0):
-    """
-    Find the most similar products, always returning top_k results if available
-    
-    Args:
-        embedding: Query embedding vector (can be numpy array, list, or database vector)
-        top_k: Number of top similar products to return (default: 3)
-        min_similarity: Minimum similarity threshold (default: 0.0 to include all)
-    """
-    conn = get_db_conn()
-    cur = conn.cursor()
-    
-    # Convert embedding to proper format for database query
-    if hasattr(embedding, 'tolist'):
-        # If it's a numpy array, convert to list
-        embedding_list = embedding.tolist()
-    elif isinstance(embedding, list):
-        # If it's already a list, use as is
-        embedding_list = embedding
-    else:
-        # If it's from database (might be string or other format), convert to list
-        if isinstance(embedding, str):
-            # Parse string representation of array
-            import ast
-            try:
-                embedding_list = ast.literal_eval(embedding)
-            except:
-                # Fallback: assume it's already in the right format
-                embedding_list = embedding
-        else:
-            embedding_list = list(embedding)
-    
-    # First, get total count to check available products
-    cur.execute("SELECT COUNT(*) FROM products WHERE embedding IS NOT NULL")
-    total_products = cur.fetchone()[0]
-    
-    if total_products == 0:
-        cur.close()
-        conn.close()
-        return []
-    
-    # Adjust top_k if there are fewer products than requested
-    actual_limit = min(top_k, total_products)
-    
-    cur.execute(
-        """
-        SELECT article_number, product_name, image_path, 
-               1 - (embedding <=> %s::vector) as similarity
-        FROM products 
-        WHERE embedding IS NOT NULL
-          AND (1 - (embedding <=> %s::vector)) >= %s
-        ORDER BY similarity DESC 
-        LIMIT %s
-        """,
-        (embedding_list, embedding_list, min_similarity, actual_limit)
-    )
-    results = cur.fetchall()
-    
-    # If we don't get enough results due to similarity threshold,
-    # get the top results regardless of threshold
-    if len(results) < actual_limit and min_similarity > 0:
-        cur.execute(
-            """
-            SELECT article_number, product_name, image_path, 
-                   1 - (embedding <=> %s::vector) as similarity
-            FROM products 
-            WHERE embedding IS NOT NULL
-            ORDER BY similarity DESC 
-            LIMIT %s
-            """,
-            (embedding_list, actual_limit)
-        )
-        results = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    return results
-
-# Fetch product by barcode
-def get_product_by_barcode(barcode):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT article_number, product_name, image_path, embedding FROM products WHERE barcode = %s",
-        (barcode,)
-    )
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result
+# Active embedding model, re-read periodically so a model cut-over is picked up
+@st.cache_data(ttl=30)
+def get_active_model():
+    """(model_id, model_name, pretrained); falls back to the CLIP_* defaults before migrations exist"""
+    try:
+        active = db_utils.get_active_model()
+    except Exception:
+        active = None  # database unreachable: encoding still works, saving will report the error
+    if active is None:
+        return None, clip_utils.CLIP_MODEL_NAME, clip_utils.CLIP_PRETRAINED
+    return active
+
+# Re-read the active model after a cut-over and re-encode the photo with it
+def reencode_with_active_model(image):
+    """(model_id, model_name, pretrained, embedding)"""
+    get_active_model.clear()
+    model_id, model_name, pretrained = get_active_model()
+    return model_id, model_name, pretrained, clip_utils.embed_image(image, model_name, pretrained)
+
+# Optionally load the model and run a dummy batch in the background at startup
+if clip_utils.CLIP_WARMUP:
+    clip_utils.start_warmup()
 
 # Function to get all uploaded files
 def get_uploaded_files(upload_folder):
@@ -166,7 +59,7 @@ def get_all_products():
     cur = conn.cursor()
     cur.execute("""
         SELECT id, article_number, product_name, image_path, barcode, 
-               created_at, updated_at, 512 as embedding_size
+               created_at, updated_at, vector_dims(embedding) as embedding_size
         FROM products 
         ORDER BY created_at DESC
     """)
@@ -183,27 +76,15 @@ def get_all_products():
     
     return valid_products
 
-# Function to clean up orphaned database records
-def cleanup_orphaned_records():
-    """Remove database records where image files no longer exist"""
-    conn = get_db_conn()
-    cur = conn.cursor()
-    
-    # Get all products with image paths
-    cur.execute("SELECT id, image_path FROM products WHERE image_path IS NOT NULL")
-    products = cur.fetchall()
-    
-    removed_count = 0
-    for product_id, image_path in products:
-        if not os.path.exists(image_path):
-            cur.execute("DELETE FROM products WHERE id = %s", (product_id,))
-            removed_count += 1
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    return removed_count
+# Start a background maintenance job and remember it for progress reporting
+def start_maintenance_job(planner, *args):
+    try:
+        job = maintenance.start_job(planner, *args)
+    except RuntimeError as e:
+        st.warning(f"⏳ {e}")
+        return None
+    st.session_state["maintenance_job_id"] = job.id
+    return job
 
 # Function to get database statistics
 def get_database_stats():
@@ -283,6 +164,58 @@ with st.sidebar:
     except Exception as e:
         st.error(f"Database connection error: {e}")
 
+    # Store/category filter applied to every similarity search on the page
+    st.header("🏬 Search Partition")
+    try:
+        search_partitions = db_utils.get_search_partitions()
+    except Exception:
+        search_partitions = []
+    stores = sorted({tenant for tenant, _, _ in search_partitions})
+    selected_store = st.selectbox("Store", ["All stores"] + stores, key="filter_store")
+    categories = sorted({
+        category for tenant, category, _ in search_partitions if selected_store in ("All stores", tenant)
+    })
+    selected_category = st.selectbox("Category", ["All categories"] + categories, key="filter_category")
+    filter_tenant = None if selected_store == "All stores" else selected_store
+    filter_category = None if selected_category == "All categories" else selected_category
+
+    # Progress of the current background maintenance job
+    maintenance_job = maintenance.get_job(st.session_state.get("maintenance_job_id"))
+    if maintenance_job:
+        st.header("🧹 Maintenance Job")
+        st.write(f"**{maintenance_job.description or 'Planning cleanup'}**")
+        st.progress(maintenance_job.progress())
+        st.caption(maintenance_job.status or maintenance_job.state)
+        for error in maintenance_job.errors:
+            st.warning(error)
+        if maintenance_job.finished:
+            if maintenance_job.state == "done":
+                st.success(f"✅ Removed {maintenance_job.rows_deleted} records and {maintenance_job.files_removed} files.")
+            else:
+                st.error(f"❌ {maintenance_job.status}")
+            if st.button("✔️ Dismiss", key="dismiss_maintenance_job"):
+                del st.session_state["maintenance_job_id"]
+                st.rerun()
+        elif st.button("🔄 Refresh Progress", key="refresh_maintenance_job"):
+            st.rerun()
+
+    # Admin panel: hot-path timings recorded by this Streamlit process
+    with st.expander("⏱️ Performance Metrics"):
+        metric_rows, slow_queries = metrics.snapshot()
+        if metric_rows:
+            st.table(metric_rows)
+        else:
+            st.info("No timings recorded yet.")
+        if metrics.SLOW_QUERY_MS:
+            st.markdown(f"**🐢 Slow queries (≥ {metrics.SLOW_QUERY_MS:.0f} ms)**")
+            if slow_queries:
+                st.table(list(reversed(slow_queries)))
+            else:
+                st.caption("None recorded.")
+        if st.button("🔄 Reset Metrics", key="reset_metrics"):
+            metrics.reset()
+            st.rerun()
+
 # === NEW: Search Similar Products Section ===
 st.markdown("---")
 st.markdown("### 🔍 Search Similar Products from Database")
@@ -363,25 +296,21 @@ try:
                 if selected_product_name:
                     selected_id = selected_product[0]
                     
-                    # Get embedding for selected product
-                    conn = get_db_conn()
-                    cur = conn.cursor()
-                    cur.execute("SELECT embedding FROM products WHERE id = %s", (selected_id,))
-                    embedding_result = cur.fetchone()
-                    cur.close()
-                    conn.close()
-                    
-                    if embedding_result and embedding_result[0]:
-                        reference_embedding = embedding_result[0]
-                        
-                        # Find similar products
-                        with st.spinner("🔍 Searching for similar products..."):
-                            similar_products = find_similar(
-                                reference_embedding, 
-                                top_k=search_top_k,
-                                min_similarity=search_threshold
+                    # Find similar products (repeat lookups are served from the result cache)
+                    with st.spinner("🔍 Searching for similar products..."):
+                        search_kwargs = dict(top_k=search_top_k, min_similarity=search_threshold,
+                                             tenant=filter_tenant, category=filter_category)
+                        try:
+                            similar_products = search_cache.find_similar_to_product(
+                                selected_id, model_id=get_active_model()[0], **search_kwargs
                             )
-                        
+                        except EmbeddingModelChanged:
+                            get_active_model.clear()
+                            similar_products = search_cache.find_similar_to_product(
+                                selected_id, model_id=get_active_model()[0], **search_kwargs
+                            )
+                    
+                    if similar_products is not None:
                         # Filter out the reference product itself
                         filtered_similar = []
                         for product in similar_products:
@@ -466,19 +395,16 @@ if uploaded_file:
     col1, col2 = st.columns([1, 2])
     
     with col1:
-        image = Image.open(uploaded_file).convert("RGB")
+        with metrics.timed("image_decode"):
+            image = Image.open(uploaded_file).convert("RGB")
         st.image(image, caption="📷 Uploaded Image", use_container_width=True)
 
     with col2:
         # Encode image with CLIP
-        model, preprocess = load_model()
-        img_tensor = preprocess(image).unsqueeze(0)
-        
         with st.spinner("🔍 Processing image with AI..."):
-            with torch.no_grad():
-                # Normalize the embedding to improve similarity search accuracy
-                embedding = model.encode_image(img_tensor).cpu().numpy().flatten()
-                embedding = embedding / np.linalg.norm(embedding)
+            # Normalized embedding to improve similarity search accuracy
+            active_model_id, active_model_name, active_pretrained = get_active_model()
+            embedding = clip_utils.embed_image(image, active_model_name, active_pretrained)
 
         # Save uploaded image locally
         upload_folder = "uploads"
@@ -491,6 +417,19 @@ if uploaded_file:
         st.markdown("#### 📝 Product Information")
         article_number = st.text_input("🏷️ Article Number (6–32 chars, A-Z, 0-9, '-')", key="article")
         product_name = st.text_input("📦 Product Name", key="product")
+        store_col, category_col = st.columns(2)
+        with store_col:
+            product_tenant = st.text_input("🏬 Store", value=filter_tenant or db_utils.DEFAULT_TENANT, key="product_store")
+        with category_col:
+            product_category = st.text_input("🗂️ Category", value=filter_category or db_utils.DEFAULT_CATEGORY,
+                                             key="product_category")
+
+        # Multi-crop mode for shelf or basket photos with several products
+        multi_crop = st.checkbox("🧩 Multi-crop mode (photo shows several products)", key="multi_crop",
+                                 help="Splits the photo into regions and searches all of them in one batch")
+        if multi_crop:
+            crop_mode = st.radio("Region layout", ["grid", "sliding"], horizontal=True, key="crop_mode")
+            crop_grid = st.slider("Grid size", 2, 4, 2, key="crop_grid") if crop_mode == "grid" else 2
 
         # Action buttons
         col_save, col_check = st.columns(2)
@@ -504,9 +443,14 @@ if uploaded_file:
                     st.error("❌ Invalid article number! Must be 6–32 characters: A-Z, 0–9, and hyphen (-) only.")
                 else:
                     try:
-                        insert_product(article_number, product_name.strip(), image_path, embedding, barcode)
+                        insert_product(article_number, product_name.strip(), image_path, embedding, barcode,
+                                       model_id=active_model_id, tenant=product_tenant.strip(),
+                                       category=product_category.strip())
                         st.session_state.session_uploads += 1  # Increment session counter
                         st.success(f"✅ Saved {product_name} (Article: {article_number}) to database!")
+                    except EmbeddingModelChanged:
+                        get_active_model.clear()
+                        st.warning("🔄 The embedding model was just upgraded. Please click Save again to re-encode the image.")
                     except Exception as e:
                         st.error(f"❌ Error saving to database: {e}")
 
@@ -516,7 +460,11 @@ if uploaded_file:
                     # Barcode verification
                     product = get_product_by_barcode(barcode)
                     if product:
-                        art_num, prod_name, img_path, db_embedding = product
+                        art_num, prod_name, img_path, db_embedding, db_model_id = product
+                        if db_model_id != active_model_id:
+                            # Stored embeddings moved to another model since this photo was encoded
+                            active_model_id, active_model_name, active_pretrained, embedding = \
+                                reencode_with_active_model(image)
                         if isinstance(db_embedding, list) or isinstance(db_embedding, np.ndarray):
                             db_embedding = np.array(db_embedding, dtype=np.float32)
                         else:
@@ -537,11 +485,57 @@ if uploaded_file:
                                 st.image(img_path, caption="Database Image", use_container_width=True)
                     else:
                         st.warning("⚠️ No product found with this barcode.")
+                elif multi_crop:
+                    # One encode pass and one batched query for all regions
+                    with st.spinner("🧩 Searching all regions of the photo..."):
+                        region_kwargs = dict(top_k=10, per_region_k=3, tenant=filter_tenant, category=filter_category,
+                                             mode=crop_mode, grid=crop_grid)
+                        try:
+                            boxes, region_matches = multicrop.search_regions(
+                                image, model_name=active_model_name, pretrained=active_pretrained,
+                                model_id=active_model_id, **region_kwargs
+                            )
+                        except EmbeddingModelChanged:
+                            get_active_model.clear()
+                            active_model_id, active_model_name, active_pretrained = get_active_model()
+                            boxes, region_matches = multicrop.search_regions(
+                                image, model_name=active_model_name, pretrained=active_pretrained,
+                                model_id=active_model_id, **region_kwargs
+                            )
+                    if region_matches:
+                        st.success(f"🎯 Found {len(region_matches)} product(s) across {len(boxes)} regions!")
+                        for idx, (article_number_result, product_name_result, image_path_result, similarity, regions, best_region) in enumerate(region_matches):
+                            with st.expander(f"🏆 #{idx + 1} Match - {product_name_result} ({similarity:.1%} similarity)", expanded=(idx == 0)):
+                                region_col1, region_col2, region_col3 = st.columns([1, 1, 2])
+                                with region_col1:
+                                    st.image(image.crop(boxes[best_region]), caption="Best Matching Region", use_container_width=True)
+                                with region_col2:
+                                    if image_path_result and os.path.exists(image_path_result):
+                                        st.image(image_path_result, caption="Product Image", use_container_width=True)
+                                    else:
+                                        st.write("🖼️ Image not available")
+                                with region_col3:
+                                    st.write(f"**📦 Product Name:** {product_name_result}")
+                                    st.write(f"**🏷️ Article Number:** {article_number_result}")
+                                    st.write(f"**🎯 Best Similarity:** {similarity:.2%}")
+                                    st.write(f"**🧩 Regions:** {', '.join('full image' if r == 0 else f'#{r}' for r in regions)}")
+                                    st.progress(similarity)
+                    else:
+                        st.info("ℹ️ No similar products found in the database.")
                 else:
                     # Similarity search
                     with st.spinner("🔍 Searching for similar products..."):
                         # Try to get top 3 similar products with very low threshold
-                        results = find_similar(embedding, top_k=3, min_similarity=0.0)
+                        try:
+                            results = search_cache.find_similar(embedding, top_k=3, min_similarity=0.0,
+                                                                tenant=filter_tenant, category=filter_category,
+                                                                model_id=active_model_id)
+                        except EmbeddingModelChanged:
+                            active_model_id, active_model_name, active_pretrained, embedding = \
+                                reencode_with_active_model(image)
+                            results = search_cache.find_similar(embedding, top_k=3, min_similarity=0.0,
+                                                                tenant=filter_tenant, category=filter_category,
+                                                                model_id=active_model_id)
                     
                     if results:
                         st.success(f"🎯 Found {len(results)} similar product(s) out of top 3!")
@@ -636,24 +630,8 @@ if uploaded_files_list:
                 if confirm_reset and st.button("🗑️ Clear All Images & Reset Counter", 
                                                type="secondary", 
                                                help="Remove all images to reset the total counter"):
-                    try:
-                        removed_count = 0
-                        for filename in uploaded_files_list:
-                            file_path = os.path.join(upload_folder, filename)
-                            if os.path.exists(file_path):
-                                try:
-                                    os.remove(file_path)
-                                    removed_count += 1
-                                except Exception as e:
-                                    st.error(f"❌ Could not remove {filename}: {e}")
-                        
-                        if removed_count > 0:
-                            st.success(f"✅ Successfully removed {removed_count} images. Total counter reset to 0!")
-                            st.rerun()
-                        else:
-                            st.warning("⚠️ No files were removed.")
-                    except Exception as e:
-                        st.error(f"❌ Error while removing images: {e}")
+                    if start_maintenance_job(maintenance.plan_remove_all_uploads, upload_folder):
+                        st.rerun()
     
     with col2_btn:
         if st.session_state.session_uploads > 0:
@@ -690,26 +668,10 @@ if uploaded_files_list:
                 st.write(f"... and {len(selected_files) - 4} more files")
             
             if st.button("🗑️ Remove Selected Images", type="secondary"):
-                try:
-                    removed_count = 0
-                    for filename in selected_files:
-                        file_path = os.path.join(upload_folder, filename)
-                        if os.path.exists(file_path):
-                            try:
-                                os.remove(file_path)
-                                st.success(f"✅ Removed: {filename}")
-                                removed_count += 1
-                            except Exception as e:
-                                st.error(f"❌ Could not remove {filename}: {e}")
-                    
-                    if removed_count > 0:
-                        st.success(f"🎉 Successfully removed {removed_count} image(s).")
-                        st.rerun()
-                    else:
-                        st.warning("⚠️ No files were removed.")
-                        
-                except Exception as e:
-                    st.error(f"❌ Error while removing selected images: {e}")
+                # Removes the files and every product record that points at them
+                selected_paths = [os.path.join(upload_folder, filename) for filename in selected_files]
+                if start_maintenance_job(maintenance.plan_remove_files, selected_paths):
+                    st.rerun()
     
     # Remove all images (with confirmation)
     with st.expander("⚠️ Remove ALL Images (Danger Zone)"):
@@ -717,24 +679,8 @@ if uploaded_files_list:
         confirm_all = st.checkbox("✅ I understand this will delete ALL uploaded images")
         
         if confirm_all and st.button("🗑️ Remove ALL Images", type="secondary"):
-            try:
-                removed_count = 0
-                for root, dirs, files in os.walk(upload_folder):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        try:
-                            os.remove(file_path)
-                            removed_count += 1
-                        except Exception as e:
-                            st.warning(f"Could not remove file {file_path}: {e}")
-                
-                if removed_count > 0:
-                    st.success(f"✅ All {removed_count} uploaded images have been removed successfully.")
-                    st.rerun()
-                else:
-                    st.info("ℹ️ No files found to remove.")
-            except Exception as e:
-                st.error(f"❌ Error while removing uploaded images: {e}")
+            if start_maintenance_job(maintenance.plan_remove_all_uploads, upload_folder):
+                st.rerun()
 else:
     st.info("📁 No uploaded images found.")
 
@@ -764,9 +710,8 @@ if st.checkbox("🔍 Show Database Contents", key="show_db_contents"):
         if stats.get('orphaned_records', 0) > 0:
             st.warning(f"Found {stats['orphaned_records']} database records with missing image files.")
             if st.button("🧹 Clean Up Orphaned Records", key="cleanup_db"):
-                removed_count = cleanup_orphaned_records()
-                st.success(f"Cleaned up {removed_count} orphaned database records!")
-                st.rerun()  # Refresh the page to update stats
+                if start_maintenance_job(maintenance.plan_orphaned_records):
+                    st.rerun()  # Refresh the page to show job progress
         
         st.markdown("#### 📋 Active Product Database")
         
@@ -812,37 +757,18 @@ st.markdown("### 🧹 Database Maintenance")
 col1, col2 = st.columns(2)
 with col1:
     if st.button("🗑️ Remove All Uploaded Images", key="remove_images"):
-        try:
-            upload_folder = "uploads"
-            removed_files = 0
-            if os.path.exists(upload_folder):
-                for root, dirs, files in os.walk(upload_folder):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        try:
-                            os.remove(file_path)
-                            removed_files += 1
-                        except Exception as e:
-                            st.warning(f"Could not remove file {file_path}: {e}")
-                st.success(f"Removed {removed_files} uploaded image files.")
-            else:
-                st.info("No uploads folder found.")
-        except Exception as e:
-            st.error(f"Error while removing uploaded images: {e}")
+        upload_folder = "uploads"
+        if not os.path.exists(upload_folder):
+            st.info("No uploads folder found.")
+        elif start_maintenance_job(maintenance.plan_remove_all_uploads, upload_folder):
+            st.rerun()
 
 with col2:
     if st.button("🗂️ Sync Database with Files", key="sync_db"):
-        try:
-            removed_count = cleanup_orphaned_records()
-            if removed_count > 0:
-                st.success(f"Cleaned up {removed_count} orphaned database records!")
-            else:
-                st.info("Database is already synchronized with image files.")
-            st.rerun()  # Refresh to update the display
-        except Exception as e:
-            st.error(f"Error during database sync: {e}")
+        if start_maintenance_job(maintenance.plan_orphaned_records):
+            st.rerun()  # Refresh to show job progress
 
-st.caption("💡 Tip: Use 'Remove All Uploaded Images' to clear files, then 'Sync Database with Files' to clean up orphaned records.")
+st.caption("💡 Tip: Removing images also deletes their database records. Use 'Sync Database with Files' to clean up records whose files were deleted outside the app. Progress is shown in the sidebar.")
 
 # Footer
 st.markdown("---")
@@ -24,3 +24,135 @@ END$$;
 
 CREATE INDEX IF NOT EXISTS idx_article_number ON products USING HASH (article_number);
 CREATE INDEX IF NOT EXISTS idx_product_name_trgm ON products USING GIN (product_name gin_trgm_ops);
+
+-- Embedding models: exactly one is active and fills products.embedding. Every
+-- other model keeps its embeddings in its own products column (staging_column),
+-- filled by app/migrate_embeddings.py; a cut-over renames the two columns.
+CREATE TABLE IF NOT EXISTS embedding_models (
+    model_id VARCHAR(128) PRIMARY KEY,
+    model_name VARCHAR(64) NOT NULL,
+    pretrained VARCHAR(256) NOT NULL,
+    dim INTEGER NOT NULL CHECK (dim > 0),
+    staging_column VARCHAR(63) NOT NULL UNIQUE,
+    is_active BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    activated_at TIMESTAMPTZ
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_embedding_models_active ON embedding_models (is_active) WHERE is_active;
+
+INSERT INTO embedding_models (model_id, model_name, pretrained, dim, staging_column, is_active, activated_at)
+SELECT 'ViT-B-32/openai', 'ViT-B-32', 'openai', 512, 'embedding_' || left(md5('ViT-B-32/openai'), 12), TRUE, NOW()
+WHERE NOT EXISTS (SELECT 1 FROM embedding_models WHERE is_active);
+
+-- Catalogue partitions: every product belongs to a tenant (store) and a category
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name='products' AND column_name='tenant'
+    ) THEN
+        ALTER TABLE products ADD COLUMN tenant VARCHAR(64) NOT NULL DEFAULT 'default';
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name='products' AND column_name='category'
+    ) THEN
+        ALTER TABLE products ADD COLUMN category VARCHAR(64) NOT NULL DEFAULT 'uncategorized';
+    END IF;
+END$$;
+
+CREATE INDEX IF NOT EXISTS idx_products_partition ON products (tenant, category);
+
+-- Partition registry: searches fan out over it, and it records each partition's
+-- partial ANN index (built with app/partitions.py)
+CREATE TABLE IF NOT EXISTS search_partitions (
+    tenant VARCHAR(64) NOT NULL,
+    category VARCHAR(64) NOT NULL,
+    index_name VARCHAR(63),
+    index_type VARCHAR(16),
+    indexed_rows BIGINT,
+    build_seconds DOUBLE PRECISION,
+    built_at TIMESTAMPTZ,
+    PRIMARY KEY (tenant, category)
+);
+
+INSERT INTO search_partitions (tenant, category)
+SELECT DISTINCT tenant, category FROM products
+ON CONFLICT DO NOTHING;
+
+-- Partition indexes built ahead of a cut-over on a candidate model's staging
+-- column; the cut-over moves them into search_partitions
+CREATE TABLE IF NOT EXISTS staged_partition_indexes (
+    model_id VARCHAR(128) NOT NULL REFERENCES embedding_models(model_id) ON DELETE CASCADE,
+    tenant VARCHAR(64) NOT NULL,
+    category VARCHAR(64) NOT NULL,
+    index_name VARCHAR(63) NOT NULL,
+    index_type VARCHAR(16) NOT NULL,
+    indexed_rows BIGINT,
+    build_seconds DOUBLE PRECISION,
+    built_at TIMESTAMPTZ,
+    PRIMARY KEY (model_id, tenant, category)
+);
+
+-- Statement-level triggers keep the registry current without per-row cost on bulk loads
+CREATE OR REPLACE FUNCTION register_search_partitions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO search_partitions (tenant, category)
+    SELECT DISTINCT tenant, category FROM new_rows
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_register_search_partitions_insert ON products;
+CREATE TRIGGER trg_register_search_partitions_insert
+    AFTER INSERT ON products
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION register_search_partitions();
+
+DROP TRIGGER IF EXISTS trg_register_search_partitions_update ON products;
+CREATE TRIGGER trg_register_search_partitions_update
+    AFTER UPDATE ON products
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION register_search_partitions();
+
+-- Catalogue version: bumped by every statement that changes the catalogue, the
+-- active embedding model or a partition index, and announced on the
+-- catalogue_changed channel. Search caches in every process key on it
+-- (app/search_cache.py). The bump commits with the change it records.
+CREATE TABLE IF NOT EXISTS catalogue_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO catalogue_state (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_catalogue_version() RETURNS trigger AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE catalogue_state SET version = version + 1 RETURNING version INTO new_version;
+    PERFORM pg_notify('catalogue_changed', new_version::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Staging-column writes of a model migration (backfill) are not catalogue changes
+-- (app/migrate_embeddings.py recreates this trigger on cut-over: column lists are
+-- stored by column number, so they would follow the renamed columns)
+DROP TRIGGER IF EXISTS trg_catalogue_version_products ON products;
+CREATE TRIGGER trg_catalogue_version_products
+    AFTER INSERT OR DELETE OR TRUNCATE
+       OR UPDATE OF article_number, product_name, image_path, embedding, barcode, tenant, category
+    ON products
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalogue_version();
+
+DROP TRIGGER IF EXISTS trg_catalogue_version_models ON embedding_models;
+CREATE TRIGGER trg_catalogue_version_models
+    AFTER UPDATE OR DELETE ON embedding_models
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalogue_version();
+
+-- New partitions arrive with a products insert, which already bumps the version
+DROP TRIGGER IF EXISTS trg_catalogue_version_partitions ON search_partitions;
+CREATE TRIGGER trg_catalogue_version_partitions
+    AFTER UPDATE OR DELETE ON search_partitions
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalogue_version();